@@ -0,0 +1,263 @@
+import argparse
+import difflib
+import hashlib
+import io
+import lzma
+import os
+import struct
+import sys
+from datetime import date
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import parse
+
+# A single file holding every data_YYYY-MM-DD snapshot. Each day is stored as the school counters
+# that changed since the previous day, and the whole stream is lzma compressed:
+#
+#   magic  b'AACPSDA1', then in the compressed stream one record per day:
+#   day    date ordinal (I), kind (B), original size (I), mtime (d), sha256 (32s)
+#   kind 0 (delta):
+#          trailing newline (B), quarantine line (H + bytes),
+#          new school names (I, then H + bytes each; ids are assigned in order of appearance),
+#          edits turning the previous delta day's school order into this one's (I, then for each:
+#          start and end of the replaced ids in the previous order I, I and the ids replacing them I + I each),
+#          changed counters (I count, I byte length, then per change two varints: the gap to the previous
+#          change's index into the day's counters, 4 per school in school order, and the zigzag encoded
+#          difference to the school's previous value)
+#   kind 1 (raw, for anything that wouldn't round trip exactly, or names a school twice):
+#          the file contents (I + bytes)
+#
+# Counters of a school carry over from the last day it was changed, starting at 0.
+# write() decodes the new archive and checks every day against its sha256 before replacing the
+# old one, read_day() and --verify check the days they return too. Ingesting doesn't, it reads the
+# counters without turning each day back into text unless asked to.
+
+MAGIC = b'AACPSDA1'
+_DAY = struct.Struct('<IBId32s')
+
+def _varints(values: List[int]) -> bytes:
+    out = bytearray()
+    for v in values:
+        while v >= 0x80:
+            out.append(v & 0x7f | 0x80)
+            v >>= 7
+        out.append(v)
+    return bytes(out)
+
+def _iter_varints(data: bytes) -> Iterator[int]:
+    v = shift = 0
+    for b in data:
+        v |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            yield v
+            v = shift = 0
+
+def _zigzag(v: int) -> int:
+    return v * 2 if v >= 0 else -v * 2 - 1
+
+def _unzigzag(v: int) -> int:
+    return v // 2 if not v & 1 else -(v + 1) // 2
+
+def _split_snapshot(data: bytes) -> Optional[Tuple[bool, bytes, List[bytes], List[List[int]]]]:
+    # (trailing newline, quarantine line, school names, counters) if rendering them gives back data exactly
+    trailing_newline = data.endswith(b'\n')
+    lines = (data[:-1] if trailing_newline else data).split(b'\n')
+    if (len(lines) - 1) % 5 != 0:
+        return None
+    names = lines[1::5]
+    counters = []
+    for i in range(1, len(lines), 5):
+        try:
+            values = [int(x) for x in lines[i + 1:i + 5]]
+        except ValueError:
+            return None
+        if [str(v).encode() for v in values] != lines[i + 1:i + 5]:
+            return None
+        counters.append(values)
+    return trailing_newline, lines[0], names, counters
+
+def _render_snapshot(trailing_newline: bool, quarantine: bytes, names: List[bytes], counters: List[List[int]]) -> bytes:
+    lines = [quarantine]
+    for name, values in zip(names, counters):
+        lines.append(name)
+        lines.extend(str(v).encode() for v in values)
+    return b'\n'.join(lines) + (b'\n' if trailing_newline else b'')
+
+def write(path: str, directory: str = '.'):
+    school_ids: Dict[bytes, int] = {}
+    state: Dict[int, List[int]] = {}
+    order: List[int] = []
+
+    out = io.BytesIO()
+    for filename in sorted(f for f in os.listdir(directory) if f.startswith('data_')):
+        full_path = os.path.join(directory, filename)
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        st = os.stat(full_path)
+        d = date.fromisoformat(filename[5:])
+        split = _split_snapshot(data)
+        if split is not None and len(set(split[2])) != len(split[2]):
+            # counters are kept per school, a second block for the same name can't be told apart
+            split = None
+        out.write(_DAY.pack(d.toordinal(), 0 if split else 1, len(data), st.st_mtime, hashlib.sha256(data).digest()))
+        if split is None:
+            out.write(struct.pack('<I', len(data)) + data)
+            continue
+
+        trailing_newline, quarantine, names, counters = split
+        new_names = [n for n in dict.fromkeys(names) if n not in school_ids]
+        for name in new_names:
+            school_ids[name] = len(school_ids)
+        ids = [school_ids[n] for n in names]
+        changes = []
+        last = -1
+        for pos, (school, values) in enumerate(zip(ids, counters)):
+            previous = state.get(school, [0, 0, 0, 0])
+            for m, (p, v) in enumerate(zip(previous, values)):
+                if p != v:
+                    changes += [pos * 4 + m - last - 1, _zigzag(v - p)]
+                    last = pos * 4 + m
+            state[school] = values
+
+        out.write(struct.pack('<BH', trailing_newline, len(quarantine)) + quarantine)
+        out.write(struct.pack('<I', len(new_names)))
+        for name in new_names:
+            out.write(struct.pack('<H', len(name)) + name)
+        edits = [(i1, i2, ids[j1:j2]) for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, order, ids, autojunk=False).get_opcodes() if tag != 'equal']
+        out.write(struct.pack('<I', len(edits)))
+        for start, end, replacement in edits:
+            out.write(struct.pack('<III{}I'.format(len(replacement)), start, end, len(replacement), *replacement))
+        order = ids
+        encoded = _varints(changes)
+        out.write(struct.pack('<II', len(changes) // 2, len(encoded)) + encoded)
+
+    # write next to the old archive and swap it in once it's known to decode to every snapshot
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(lzma.compress(out.getvalue(), preset=9 | lzma.PRESET_EXTREME))
+    try:
+        verify(path + '.tmp', directory)
+    except ValueError:
+        os.unlink(path + '.tmp')
+        raise
+    os.replace(path + '.tmp', path)
+
+def _read_exact(f: BinaryIO, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError('truncated archive')
+    return data
+
+def iter_days(path: str) -> Iterator[Tuple[date, Tuple[int, float, str], Optional[bytes], Optional[Tuple[bool, bytes, List[bytes], List[List[int]]]]]]:
+    # (date, (size, mtime, hash), raw contents, None) for raw days,
+    # (date, (size, mtime, hash), None, (trailing newline, quarantine line, school names, counters)) for delta days
+    names: List[bytes] = []
+    state: Dict[int, List[int]] = {}
+    order: List[int] = []
+
+    with open(path, 'rb') as raw:
+        if raw.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a snapshot archive'.format(path))
+        with lzma.open(raw) as f:
+            while True:
+                header = f.read(_DAY.size)
+                if not header:
+                    break
+                ordinal, kind, size, mtime, digest = _DAY.unpack(header)
+                meta = (size, mtime, digest.hex())
+                if kind == 1:
+                    length, = struct.unpack('<I', _read_exact(f, 4))
+                    yield date.fromordinal(ordinal), meta, _read_exact(f, length), None
+                    continue
+
+                trailing_newline, length = struct.unpack('<BH', _read_exact(f, 3))
+                quarantine = _read_exact(f, length)
+                n_names, = struct.unpack('<I', _read_exact(f, 4))
+                for _ in range(n_names):
+                    length, = struct.unpack('<H', _read_exact(f, 2))
+                    names.append(_read_exact(f, length))
+                n_edits, = struct.unpack('<I', _read_exact(f, 4))
+                edits = []
+                for _ in range(n_edits):
+                    start, end, n_ids = struct.unpack('<III', _read_exact(f, 12))
+                    edits.append((start, end, struct.unpack('<{}I'.format(n_ids), _read_exact(f, 4 * n_ids))))
+                # the positions are in the previous order, apply the edits back to front
+                for start, end, replacement in reversed(edits):
+                    order[start:end] = replacement
+                n_changes, length = struct.unpack('<II', _read_exact(f, 8))
+                changes = _iter_varints(_read_exact(f, length))
+                index = -1
+                for _ in range(n_changes):
+                    index += next(changes) + 1
+                    pos, m = divmod(index, 4)
+                    counters = state.setdefault(order[pos], [0, 0, 0, 0])
+                    counters[m] += _unzigzag(next(changes))
+                yield date.fromordinal(ordinal), meta, None, (trailing_newline, quarantine, [names[i] for i in order], [list(state.get(i, (0, 0, 0, 0))) for i in order])
+
+def _checked(d: date, meta: Tuple[int, float, str], raw: Optional[bytes], split) -> bytes:
+    # the day's snapshot, if it hashes to what was recorded when it was packed
+    data = raw if raw is not None else _render_snapshot(*split)
+    if hashlib.sha256(data).hexdigest() != meta[2]:
+        raise ValueError('{} does not decode to the packed snapshot'.format(d.isoformat()))
+    return data
+
+def read_day(path: str, d: date) -> bytes:
+    # the exact contents of data_YYYY-MM-DD for d
+    for day, meta, raw, split in iter_days(path):
+        if day == d:
+            return _checked(day, meta, raw, split)
+    raise KeyError(d.isoformat())
+
+def verify(path: str, directory: Optional[str] = None) -> int:
+    # checks every day against its sha256 and, with directory, against the data_* file there;
+    # returns the number of days
+    days = 0
+    for d, meta, raw, split in iter_days(path):
+        data = _checked(d, meta, raw, split)
+        if directory is not None:
+            with open(os.path.join(directory, 'data_{}'.format(d.isoformat())), 'rb') as f:
+                if f.read() != data:
+                    raise ValueError('{} differs from data_{}'.format(d.isoformat(), d.isoformat()))
+        days += 1
+    return days
+
+def iter_rows(path: str, skip: Optional[Dict[str, str]] = None, check: bool = False) -> Iterator[Tuple[date, Tuple[int, float, str], tuple, List[tuple]]]:
+    # the same rows parse.iter_parse() gives for each day, straight from the counters;
+    # days whose hash matches skip (Datestamp -> hash) aren't yielded, check renders each day to compare its sha256
+    skip = skip or {}
+    for d, meta, raw, split in iter_days(path):
+        d_str = d.isoformat()
+        if skip.get(d_str) == meta[2]:
+            continue
+        if check:
+            _checked(d, meta, raw, split)
+        if raw is not None:
+            rows = parse.iter_parse_lines(io.StringIO(raw.decode()), d, '{}:{}'.format(path, d_str))
+            yield d, meta, next(rows), list(rows)
+            continue
+        _, quarantine, names, counters = split
+        students_quarantined, staff_quarantined = quarantine.decode().strip().split(',')
+        yield d, meta, (d_str, students_quarantined, staff_quarantined), [(name.decode().strip(), d_str, *values) for name, values in zip(names, counters)]
+
+def ingest(db_conn, path: str, check: bool = False) -> int:
+    known = {row[0]: row[1] for row in db_conn.execute('SELECT Datestamp, Hash FROM manifest')}
+    return parse.load_days(db_conn, iter_rows(path, known, check))
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Pack the data_* snapshots into a delta encoded archive, or extract a day from one')
+    parser.add_argument('archive', help='archive file')
+    parser.add_argument('-d', '--directory', default='.', help='where the data_* files are')
+    parser.add_argument('--extract', metavar='YYYY-MM-DD', help='write that day\'s snapshot to stdout instead of packing')
+    parser.add_argument('--verify', action='store_true', help='check that the archive decodes to the data_* files instead of packing')
+    args = parser.parse_args(argv)
+
+    if args.extract:
+        sys.stdout.buffer.write(read_day(args.archive, date.fromisoformat(args.extract)))
+    elif args.verify:
+        print('{} days match'.format(verify(args.archive, args.directory)))
+    else:
+        write(args.archive, args.directory)
+
+if __name__ == '__main__':
+    main()
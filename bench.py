@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Generates a synthetic district at any scale and times each stage of the
+# ingest -> summarize -> model -> render pipeline on it, writing the results as JSON
+# so runs on different commits can be compared:
+#
+#   python3 bench.py --years 10 --schools 5000
+#   python3 bench.py --years 10 --schools 5000 --compare bench_results/<older commit>.json
+
+levels = ['High', 'Middle', 'Elementary', 'Specialty Centers', 'Charter/Contract']
+level_weights = [0.12, 0.18, 0.6, 0.05, 0.05]
+# roughly Anne Arundel County
+latitude_range = (38.70, 39.25)
+longitude_range = (-76.85, -76.40)
+
+def generate(directory: str, years: int = 1, schools: int = 200, seed: int = 0, start: date = date(2021, 9, 14)) -> int:
+    # writes school_list_geo and one data_YYYY-MM-DD file per weekday, returns the number of files
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    level = rng.choice(len(levels), size=schools, p=level_weights)
+    students = rng.integers(300, 2500, size=schools)
+    latitude = rng.uniform(*latitude_range, size=schools)
+    longitude = rng.uniform(*longitude_range, size=schools)
+    names = ['Synthetic {} {:05d}'.format(levels[lv], i) for i, lv in enumerate(level)]
+    with open(os.path.join(directory, 'school_list_geo'), 'w') as f:
+        f.write('\n'.join('{},{},{},{:.6f},{:.6f}'.format(n, levels[lv], s, lat, lon)
+                          for n, lv, s, lat, lon in zip(names, level, students, latitude, longitude)))
+
+    days = [start + timedelta(days=i) for i in range(365 * years) if (start + timedelta(days=i)).weekday() < 5]
+    # each school's cases follow a random walk: new cases in proportion to its size, resolved after about 10 days
+    rate = students / 20000
+    active_student = np.zeros(schools, dtype=np.int64)
+    total_student = np.zeros(schools, dtype=np.int64)
+    active_staff = np.zeros(schools, dtype=np.int64)
+    total_staff = np.zeros(schools, dtype=np.int64)
+    for d in days:
+        wave = 1 + np.sin(2 * np.pi * (d - start).days / 180)
+        new_student = rng.poisson(rate * wave)
+        new_staff = rng.poisson(rate * wave / 8)
+        active_student += new_student - rng.binomial(active_student, 0.1)
+        total_student += new_student
+        active_staff += new_staff - rng.binomial(active_staff, 0.1)
+        total_staff += new_staff
+        lines = ['{},{}'.format(int(active_student.sum() * 4), int(active_staff.sum() * 2))]
+        for block in zip(names, active_student, total_student, active_staff, total_staff):
+            lines.extend(str(x) for x in block)
+        with open(os.path.join(directory, 'data_{}'.format(d.isoformat())), 'w') as f:
+            f.write('\n'.join(lines))
+    return len(days)
+
+class Recorder:
+    # tracemalloc slows allocation heavy stages down several times, so the Python heap peak
+    # is only recorded when asked for; the process high water mark (max_rss_bytes) always is
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.stages: List[Dict[str, object]] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        # the body fills in stage['rows'] when it knows how much it processed
+        stage = {'stage': name, 'rows': None}
+        if self.trace_memory:
+            tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            stage['wall_s'] = time.perf_counter() - wall
+            stage['cpu_s'] = time.process_time() - cpu
+            if self.trace_memory:
+                stage['peak_alloc_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            stage['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+            if stage['rows'] is not None and stage['wall_s'] > 0:
+                stage['rows_per_s'] = stage['rows'] / stage['wall_s']
+            self.stages.append(stage)
+            print('{:<24} {:>9.3f}s wall {:>9.3f}s cpu {:>12} rows {:>10.1f} MB rss{}'.format(
+                name, stage['wall_s'], stage['cpu_s'], '-' if stage['rows'] is None else stage['rows'], stage['max_rss_bytes'] / 1e6,
+                ' {:>10.1f} MB traced peak'.format(stage['peak_alloc_bytes'] / 1e6) if self.trace_memory else ''))
+
+def run(directory: str, years: int, frames: int, jobs: int, trace_memory: bool = False) -> List[Dict[str, object]]:
+    # the stages run in directory, which needs school_list_geo and the data_* files
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(directory)
+    import parse
+    import techniques
+
+    recorder = Recorder(trace_memory)
+    with recorder.stage('parse_main') as stage:
+        parse.main(['-j', str(jobs)])
+        db_conn = sqlite3.connect('cases.db')
+        stage['rows'] = db_conn.execute('SELECT COUNT(*) FROM cases').fetchone()[0]
+    with recorder.stage('parse_main_noop'):
+        parse.main(['-j', str(jobs)])
+
+    total_students = db_conn.execute('SELECT SUM(Students) FROM school_level').fetchone()[0]
+    with recorder.stage('summarize') as stage:
+        df_summary = techniques.summarize(db_conn, total_students)
+        stage['rows'] = len(df_summary)
+    with recorder.stage('summarize_recompute') as stage:
+        stage['rows'] = len(techniques.summarize(db_conn, total_students, recompute=True))
+
+    with recorder.stage('model2') as stage:
+        model = techniques.Model2(df_summary, df_summary.index[0], total_students, seroprevalence=0.3, r0=1.1,
+                                  quarantine_factor=5, quarantine_period=10)
+        model.run(365 * years)
+        stage['rows'] = len(model.df)
+
+    import make_gif
+    with recorder.stage('render_load_panel') as stage:
+        panel = make_gif.load_panel(db_conn)
+        stage['rows'] = len(panel)
+    days = list(panel.groupby('Datestamp'))[1:frames + 1]
+    with recorder.stage('render_frames') as stage:
+        basemap, bounds = make_gif.make_basemap(panel)
+        for d, df in days:
+            make_gif.render_frame(d.strftime('%Y-%m-%d'), *make_gif._bubbles(df), basemap, bounds)
+        stage['rows'] = len(days)
+    # plotday() shows its figure, keep the html it writes in directory (already the working directory) where clean() finds it
+    from bokeh.io import output_file
+    output_file('plotday.html')
+    with recorder.stage('plotday') as stage:
+        for d, df in days:
+            make_gif.plotday(d.strftime('%Y-%m-%d'), df)
+        stage['rows'] = len(days)
+
+    db_conn.close()
+    return recorder.stages
+
+# written next to the generated files, a reused --workdir is only kept when it matches the requested scale
+scale_file = 'bench_scale.json'
+
+def _generated_scale(directory: str) -> Optional[Dict[str, int]]:
+    try:
+        with open(os.path.join(directory, scale_file)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def clean(directory: str, generated: bool = False):
+    # removes what the stages write, and with generated also the synthetic input, so a reused directory starts over
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name == 'cube':
+            shutil.rmtree(path)
+        elif name in ('cases.db', 'cases.db-wal', 'cases.db-shm', 'plotday.html') or (
+                generated and (name.startswith('data_') or name in ('school_list_geo', scale_file))):
+            os.unlink(path)
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current: Dict[str, object], baseline: Dict[str, object], threshold: float) -> List[str]:
+    # stages whose wall time grew by more than threshold times against baseline
+    before = {s['stage']: s for s in baseline['stages']}
+    regressions = []
+    for stage in current['stages']:
+        old = before.get(stage['stage'])
+        if old is None or old['wall_s'] <= 0:
+            continue
+        ratio = stage['wall_s'] / old['wall_s']
+        print('{:<24} {:>7.2f}x'.format(stage['stage'], ratio))
+        if ratio > threshold:
+            regressions.append(stage['stage'])
+    return regressions
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic district')
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--schools', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--frames', type=int, default=20, help='number of map frames to render')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='processes used to parse the snapshots')
+    parser.add_argument('--trace-memory', action='store_true', help='also record each stage\'s Python heap peak (slows the stages down)')
+    parser.add_argument('--workdir', help='generate into (or reuse, at the same scale) this directory instead of a temporary one')
+    parser.add_argument('-o', '--output', help='results file, bench_results/<commit>.json by default')
+    parser.add_argument('--compare', help='results file of an earlier run, exits non-zero on regressions')
+    parser.add_argument('--threshold', type=float, default=1.25, help='wall time ratio counted as a regression')
+    args = parser.parse_args(argv)
+
+    here = os.getcwd()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='aacps_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    scale = {'years': args.years, 'schools': args.schools, 'seed': args.seed}
+    generated = _generated_scale(workdir)
+    if generated is None and os.path.exists(os.path.join(workdir, 'school_list_geo')):
+        # never delete snapshots bench.py didn't write, e.g. with --workdir pointing at the checkout
+        parser.error('{} has data bench.py didn\'t generate, use an empty directory'.format(workdir))
+    try:
+        if generated != scale:
+            start = time.perf_counter()
+            clean(workdir, generated=True)
+            files = generate(workdir, args.years, args.schools, args.seed)
+            with open(os.path.join(workdir, scale_file), 'w') as f:
+                json.dump(scale, f)
+            print('generated {} files for {} schools in {:.1f}s'.format(files, args.schools, time.perf_counter() - start))
+        else:
+            clean(workdir)
+            files = len([f for f in os.listdir(workdir) if f.startswith('data_')])
+        schools = args.schools
+        stages = run(workdir, args.years, args.frames, args.jobs, args.trace_memory)
+    finally:
+        os.chdir(here)
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    commit = _commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'files': files,
+        'schools': schools,
+        'trace_memory': args.trace_memory,
+        'stages': stages
+    }
+    output = args.output or os.path.join('bench_results', '{}.json'.format(commit or 'unknown'))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline['files'], baseline['schools']) != (files, schools):
+            print('warning: baseline ran on {} files x {} schools'.format(baseline['files'], baseline['schools']))
+        if baseline.get('trace_memory') != args.trace_memory:
+            print('warning: only one of the runs traced memory, their times aren\'t comparable')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('regressions: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import sys
+from typing import List, Optional
+
+# One entry point for the scheduled jobs:
+#
+#   python3 cli.py ingest [parse.py options]      load the data_* snapshots into cases.db, standard library only
+#   python3 cli.py summarize [-o summary.csv]     write the daily summary as csv
+#   python3 cli.py render [make_gif.py options]   render the animation
+#   python3 cli.py model [--model model3] ...     project cases forward from a day of the summary
+#
+# Only argparse and sys are imported here, each subcommand imports what it needs when it runs.
+
+def ingest(argv: List[str]):
+    import parse
+    parse.main(argv)
+
+def render(argv: List[str]):
+    import make_gif
+    make_gif.main(argv)
+
+def summarize(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='cli.py summarize', description='Write the daily summary from cases.db as csv')
+    parser.add_argument('--db', default='cases.db', help='database built by the ingest command')
+    parser.add_argument('--total-students', type=int, default=85000)
+    parser.add_argument('--recompute', action='store_true', help='aggregate the cases table instead of reading daily_summary')
+    parser.add_argument('-o', '--output', default='summary.csv')
+    parser.add_argument('--transposed', default='summary_T.csv', help='also write it with the dates as columns, an empty string skips it')
+    args = parser.parse_args(argv)
+
+    import sqlite3
+    from contextlib import closing
+    import techniques
+    with closing(sqlite3.connect(args.db)) as db_conn:
+        df_summary = techniques.summarize(db_conn, args.total_students, args.recompute)
+    df_summary.to_csv(args.output)
+    if args.transposed:
+        df_summary.T.to_csv(args.transposed)
+
+def model(argv: List[str]):
+    parser = argparse.ArgumentParser(prog='cli.py model', description='Project student cases forward and write the projection as csv')
+    parser.add_argument('--model', choices=['model2', 'model3'], default='model2', help='model3 runs stochastic replicates and writes percentile bands')
+    parser.add_argument('--db', default='cases.db', help='database built by the ingest command')
+    parser.add_argument('--start-date', help='YYYY-MM-DD, a day in the summary, the latest one by default')
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--total-students', type=int, default=85000)
+    parser.add_argument('--seroprevalence', type=float, default=0, help='model2 only')
+    parser.add_argument('--r0', type=float, default=1)
+    parser.add_argument('--quarantine-factor', type=float, default=0)
+    parser.add_argument('--quarantine-period', type=int, default=10)
+    parser.add_argument('--quarantine-success', type=float, default=0, help='model3 only')
+    parser.add_argument('--replicates', type=int, default=1000, help='model3 only')
+    parser.add_argument('--seed', type=int, help='model3 only')
+    parser.add_argument('-o', '--output', default='-', help='csv file, stdout by default')
+    args = parser.parse_args(argv)
+
+    import sqlite3
+    from contextlib import closing
+    import pandas as pd
+    import techniques
+    with closing(sqlite3.connect(args.db)) as db_conn:
+        df_summary = techniques.summarize(db_conn, args.total_students)
+    start_date = df_summary.index[-1] if args.start_date is None else pd.Timestamp(args.start_date)
+    if start_date not in df_summary.index:
+        parser.error('{} is not in the summary'.format(start_date.date()))
+
+    if args.model == 'model2':
+        projection = techniques.Model2(df_summary, start_date, args.total_students, args.seroprevalence, args.r0, args.quarantine_factor,
+                                       quarantine_period=args.quarantine_period)
+        projection.run(args.days)
+        df = projection.df
+    else:
+        projection = techniques.Model3(df_summary, start_date, args.total_students, args.r0, args.quarantine_factor, args.quarantine_success,
+                                       quarantine_period=args.quarantine_period, replicates=args.replicates, seed=args.seed)
+        projection.run(args.days)
+        df = projection.bands()
+    df.to_csv(sys.stdout if args.output == '-' else args.output)
+
+commands = {
+    'ingest': ingest,
+    'summarize': summarize,
+    'render': render,
+    'model': model
+}
+
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(prog='cli.py', usage='%(prog)s [-h] {{{}}} ...'.format(','.join(commands)),
+                                     description='AACPS covid data pipeline',
+                                     epilog='run "cli.py <command> --help" for the options of a command')
+    parser.add_argument('command', choices=commands)
+    # everything after the command belongs to it, including --help
+    args = parser.parse_args(argv[:1])
+    commands[args.command](argv[1:])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import ast
+import bisect
+import os
+import sqlite3
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# The cases table as a dense (date x metric x school) int32 array, stored as a .npy file next to
+# the school and date axes so it can be memory-mapped. A school that isn't in a day's snapshot
+# counts 0, so sums over schools match the cases table; present.npy, a (date x school) bool array,
+# tells those apart from real zeros. Writing only needs the standard library so parse.py can keep
+# it up to date; reading needs numpy.
+#
+# Each day is one contiguous block, so write_cube() only rewrites the days whose snapshot hash in
+# the manifest differs from the one in hashes.txt, and appends new days after the last one. The
+# whole cube is rebuilt when the school axis changes or a day lands before the last one.
+
+METRICS = ['Active_Student', 'Total_Student', 'Active_Staff', 'Total_Staff']
+# headers are padded to a fixed size so the shape can be rewritten in place when days are appended
+_HEADER_SIZE = 128
+
+def _npy_header(shape, descr: str = '<i4') -> bytes:
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}), }}".format(descr, ''.join('{}, '.format(n) for n in shape))
+    # the magic string, version and header length take 10 bytes
+    header += ' ' * (_HEADER_SIZE - 11 - len(header)) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+def _npy_shape(path: str) -> Optional[Tuple[int, ...]]:
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER_SIZE)
+    except OSError:
+        return None
+    if len(header) != _HEADER_SIZE or not header.startswith(b'\x93NUMPY') or int.from_bytes(header[8:10], 'little') != _HEADER_SIZE - 10:
+        return None
+    return ast.literal_eval(header[10:].decode('latin1'))['shape']
+
+def _read_lines(path: str) -> Optional[List[str]]:
+    try:
+        with open(path) as f:
+            content = f.read()
+    except OSError:
+        return None
+    return content.split('\n') if content else []
+
+def _write_lines(directory: str, name: str, lines: List[str]):
+    with open(os.path.join(directory, name + '.tmp'), 'w') as f:
+        f.write('\n'.join(lines))
+    os.replace(os.path.join(directory, name + '.tmp'), os.path.join(directory, name))
+
+def _day_block(db_conn: sqlite3.Connection, d: str, school_index: Dict[str, int]) -> Tuple[array, bytearray]:
+    # (metric x school) counters and (school) presence of one day; KeyError for a school not on the axis
+    n_schools = len(school_index)
+    values = array('i', [0]) * (len(METRICS) * n_schools)
+    present = bytearray(n_schools)
+    for school, *counts in db_conn.execute('SELECT School, {} FROM cases WHERE Datestamp = ?'.format(', '.join(METRICS)), (d, )):
+        i = school_index[school]
+        present[i] = 1
+        for m, count in enumerate(counts):
+            values[m * n_schools + i] = count
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, present
+
+def _update(db_conn: sqlite3.Connection, directory: str, listed: List[str], days: List[Tuple[str, str]]) -> bool:
+    # writes the days that changed into the existing cube, False if it has to be rebuilt instead
+    schools = _read_lines(os.path.join(directory, 'schools.txt'))
+    dates = _read_lines(os.path.join(directory, 'dates.txt'))
+    hashes = _read_lines(os.path.join(directory, 'hashes.txt'))
+    if schools is None or dates is None or hashes is None or len(hashes) != len(dates):
+        return False
+    # a crash between writing the arrays and the axes leaves their shapes out of step
+    if _npy_shape(os.path.join(directory, 'cases.npy')) != (len(dates), len(METRICS), len(schools)) \
+            or _npy_shape(os.path.join(directory, 'present.npy')) != (len(dates), len(schools)):
+        return False
+    # listed schools first in order, then the unlisted ones
+    if schools[:len(listed)] != listed or not set(schools[len(listed):]).isdisjoint(listed):
+        return False
+    # days can only be added after the last one
+    if [d for d, _ in days[:len(dates)]] != dates:
+        return False
+
+    school_index = {s: i for i, s in enumerate(schools)}
+    block = len(METRICS) * len(schools)
+    changed = [(j, d, h) for j, (d, h) in enumerate(days) if j >= len(dates) or not h or hashes[j] != h]
+    try:
+        blocks = [(j, *_day_block(db_conn, d, school_index)) for j, d, _ in changed]
+    except KeyError:
+        # a school the axis doesn't have yet
+        return False
+
+    with open(os.path.join(directory, 'cases.npy'), 'r+b') as values_file, open(os.path.join(directory, 'present.npy'), 'r+b') as present_file:
+        for j, values, present in blocks:
+            values_file.seek(_HEADER_SIZE + j * block * 4)
+            values.tofile(values_file)
+            present_file.seek(_HEADER_SIZE + j * len(schools))
+            present_file.write(present)
+        if len(days) != len(dates):
+            values_file.seek(0)
+            values_file.write(_npy_header((len(days), len(METRICS), len(schools))))
+            present_file.seek(0)
+            present_file.write(_npy_header((len(days), len(schools)), '|b1'))
+    # the axes go last, until then the next run sees the old hashes and writes those days again
+    if len(days) != len(dates):
+        _write_lines(directory, 'dates.txt', [d for d, _ in days])
+    _write_lines(directory, 'hashes.txt', [h for _, h in days])
+    return True
+
+def write_cube(db_conn: sqlite3.Connection, directory: str = 'cube'):
+    listed = [row[0] for row in db_conn.execute('SELECT School FROM school_level ORDER BY School')]
+    # the snapshot hash of each day tells which days changed since the cube was written
+    days = [(d, h or '') for d, h in db_conn.execute('SELECT Datestamp, Hash FROM dates LEFT JOIN manifest USING(Datestamp) ORDER BY Datestamp')]
+    if _update(db_conn, directory, listed, days):
+        return
+
+    # schools that are missing from school_list_geo still get a row, after the listed ones
+    schools = listed + [row[0] for row in db_conn.execute('SELECT DISTINCT School FROM cases WHERE School NOT IN (SELECT School FROM school_level) ORDER BY School')]
+    school_index = {s: i for i, s in enumerate(schools)}
+
+    os.makedirs(directory, exist_ok=True)
+    # write next to the old files and swap them in, readers may have the old ones mapped
+    with open(os.path.join(directory, 'cases.npy.tmp'), 'wb') as values_file, open(os.path.join(directory, 'present.npy.tmp'), 'wb') as present_file:
+        values_file.write(_npy_header((len(days), len(METRICS), len(schools))))
+        present_file.write(_npy_header((len(days), len(schools)), '|b1'))
+        for d, _ in days:
+            values, present = _day_block(db_conn, d, school_index)
+            values.tofile(values_file)
+            present_file.write(present)
+    for name in ['cases.npy', 'present.npy']:
+        os.replace(os.path.join(directory, name + '.tmp'), os.path.join(directory, name))
+    _write_lines(directory, 'schools.txt', schools)
+    _write_lines(directory, 'dates.txt', [d for d, _ in days])
+    _write_lines(directory, 'hashes.txt', [h for _, h in days])
+
+class Cube:
+    def __init__(self, directory: str = 'cube'):
+        import numpy as np
+
+        # memory-mapped, slices are views into the file rather than copies. write_cube() updates
+        # changed days in place, reopen to see days appended since
+        self.values = np.load(os.path.join(directory, 'cases.npy'), mmap_mode='r')
+        # (school x date), False where the school wasn't in that day's snapshot
+        self.present = np.load(os.path.join(directory, 'present.npy'), mmap_mode='r').T
+        with open(os.path.join(directory, 'schools.txt')) as f:
+            self.schools = f.read().split('\n')
+        with open(os.path.join(directory, 'dates.txt')) as f:
+            self.dates = f.read().split('\n')
+        self._school_index = {s: i for i, s in enumerate(self.schools)}
+        self._date_index = {d: i for i, d in enumerate(self.dates)}
+
+    def metric(self, metric: str):
+        # (school x date)
+        return self.values[:, METRICS.index(metric), :].T
+
+    def school(self, school: str, metric: Optional[str] = None):
+        # (metric x date), or the dates of a single metric; self.present[i] says which dates it was reported on
+        series = self.values[:, :, self._school_index[school]].T
+        return series if metric is None else series[METRICS.index(metric)]
+
+    def day(self, d: str, metric: Optional[str] = None):
+        # (metric x school), or the schools of a single metric; self.present[:, j] says which schools were reported
+        cross_section = self.values[self._date_index[d]]
+        return cross_section if metric is None else cross_section[METRICS.index(metric)]
+
+    def date_slice(self, start: str, end: str) -> slice:
+        # dates are sorted, so [start, end] is a contiguous slice of the date axis
+        return slice(bisect.bisect_left(self.dates, start), bisect.bisect_right(self.dates, end))
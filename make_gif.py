@@ -1,16 +1,26 @@
 import pandas as pd
-pd.set_option('plotting.backend', 'pandas_bokeh')
 import sqlite3
-db_conn = sqlite3.connect('cases.db')
-total_students = 85000
-import techniques
-from PIL import Image
-import glob
-from bokeh.io import export_png
+from PIL import Image, ImageChops, ImageDraw
+import argparse
+import hashlib
+import io
 import os
+import profiling
+import re
+import struct
+import subprocess
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, nullcontext
+from typing import List, Optional, Tuple
 
-def plotday(d: pd.Timestamp):
-    df = pd.read_sql_query('''
+frame_size = (1024, 800)
+# bump when the drawing code changes so cached frames are re-rendered
+frame_version = 1
+
+def load_panel(db_conn: sqlite3.Connection, d: Optional[str] = None) -> pd.DataFrame:
+    # every school on every date (or just on d) with its coordinates, in one query
+    return pd.read_sql_query('''
         SELECT
             Datestamp,
             cases.School,
@@ -22,10 +32,18 @@ def plotday(d: pd.Timestamp):
         FROM
             cases
         LEFT JOIN school_level USING(School)
-        WHERE Datestamp='{}';
-        '''.format(d), db_conn, parse_dates='Datestamp'
+        {}
+        ORDER BY Datestamp;
+        '''.format('' if d is None else 'WHERE Datestamp = ?'), db_conn, params=None if d is None else (d, ), parse_dates='Datestamp'
     )
-    df["size"] = df.Active_Student / df.Student_Pop * 500
+
+def plotday(d: str, df: Optional[pd.DataFrame] = None, db_conn: Optional[sqlite3.Connection] = None):
+    # registers DataFrame.plot_bokeh
+    import pandas_bokeh
+    if df is None:
+        with closing(sqlite3.connect('cases.db')) if db_conn is None else nullcontext(db_conn) as conn:
+            df = load_panel(conn, d)
+    df = df.assign(size=df.Active_Student / df.Student_Pop * 500)
     fig = df.dropna().plot_bokeh.map(
         title="Active Cases {}".format(d),
         x="Longitude",
@@ -38,22 +56,266 @@ def plotday(d: pd.Timestamp):
     )
     return fig
 
-def main():
-    df = techniques.summarize(db_conn, total_students)
-    for d in df.index[1:]:
-        d_str = d.strftime('%Y-%m-%d')
-        fig = plotday(d_str)
-        export_png(fig, filename='active_cases_{}.png'.format(d_str))
-    
-    fp_in = "active_cases_*.png"
-    fp_out = "active_cases.gif"
-    
-    # https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#gif
-    img, *imgs = [Image.open(f) for f in sorted(glob.glob(fp_in))]
-    img.save(fp=fp_out, format='GIF', append_images=imgs,
-             save_all=True, duration=500, loop=0)
-    for f in glob.glob(fp_in):
-        os.unlink(f)
+def _mercator(lon: np.ndarray, lat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    return np.radians(lon), np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+def _lon_lat(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # inverse of _mercator
+    return np.degrees(x), np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)
+
+def _bubbles(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # same points and sizes as plotday(), sizes are bubble diameters in pixels
+    df = df.assign(size=df.Active_Student / df.Student_Pop * 500).dropna()
+    df = df[np.isfinite(df['size'])]
+    return df.Longitude.to_numpy(), df.Latitude.to_numpy(), df['size'].to_numpy()
+
+def basemap_bounds(panel: pd.DataFrame) -> Tuple[float, float, float, float]:
+    # (lon0, lat0, lon1, lat1) the frames cover when no bounds are given: the schools' extent padded by 5%,
+    # the shorter side stretched to the frame's aspect ratio
+    schools = panel.dropna(subset=['Latitude', 'Longitude']).drop_duplicates('School')
+    x, y = _mercator(schools.Longitude.to_numpy(), schools.Latitude.to_numpy())
+    width, height = frame_size
+    cx, cy = (x.min() + x.max()) / 2, (y.min() + y.max()) / 2
+    span_x, span_y = (x.max() - x.min()) * 1.1, (y.max() - y.min()) * 1.1
+    span_x, span_y = max(span_x, span_y * width / height), max(span_y, span_x * height / width)
+    lon, lat = _lon_lat(np.array([cx - span_x / 2, cx + span_x / 2]), np.array([cy - span_y / 2, cy + span_y / 2]))
+    return float(lon[0]), float(lat[0]), float(lon[1]), float(lat[1])
+
+def make_basemap(panel: pd.DataFrame, basemap_path: Optional[str] = None,
+                 bounds: Optional[Tuple[float, float, float, float]] = None) -> Tuple[Image.Image, Tuple[float, float, float, float]]:
+    # every school with coordinates on a plain background (or basemap_path, stretched over bounds), returns it with
+    # the mercator bounds the frames are drawn in; bounds are (lon0, lat0, lon1, lat1), basemap_bounds(panel) by default
+    schools = panel.dropna(subset=['Latitude', 'Longitude']).drop_duplicates('School')
+    x, y = _mercator(schools.Longitude.to_numpy(), schools.Latitude.to_numpy())
+    lon0, lat0, lon1, lat1 = basemap_bounds(panel) if bounds is None else bounds
+    (x0, x1), (y0, y1) = _mercator(np.array([lon0, lon1]), np.array([lat0, lat1]))
+    bounds = (float(x0), float(y0), float(x1), float(y1))
+
+    if basemap_path is not None:
+        basemap = Image.open(basemap_path).convert('RGB').resize(frame_size)
+    else:
+        basemap = Image.new('RGB', frame_size, (242, 239, 233))
+    draw = ImageDraw.Draw(basemap)
+    for px, py in zip(*_to_pixels(x, y, bounds)):
+        draw.ellipse([px - 2, py - 2, px + 2, py + 2], fill=(190, 190, 190))
+    return basemap, bounds
+
+def _to_pixels(x: np.ndarray, y: np.ndarray, bounds: Tuple[float, float, float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    x0, y0, x1, y1 = bounds
+    width, height = frame_size
+    return (x - x0) / (x1 - x0) * width, height - (y - y0) / (y1 - y0) * height
+
+def render_frame(d: str, lon: np.ndarray, lat: np.ndarray, size: np.ndarray,
+                 basemap: Image.Image, bounds: Tuple[float, float, float, float]) -> Image.Image:
+    img = basemap.copy()
+    draw = ImageDraw.Draw(img, 'RGBA')
+    for px, py, r in zip(*_to_pixels(*_mercator(lon, lat), bounds), size / 2):
+        if r <= 0:
+            continue
+        draw.ellipse([px - r, py - r, px + r, py + r], fill=(31, 119, 180, 128), outline=(31, 119, 180, 255))
+    draw.text((10, 10), "Active Cases {}".format(d), fill=(0, 0, 0))
+    return img
+
+_worker_basemap = None
+
+def _init_worker(basemap_png: bytes, bounds: Tuple[float, float, float, float]):
+    global _worker_basemap
+    _worker_basemap = (Image.open(io.BytesIO(basemap_png)).convert('RGB'), bounds)
+
+def _render_png(args) -> str:
+    d, lon, lat, size, filename = args
+    # intermediate frames, favour speed over size
+    render_frame(d, lon, lat, size, *_worker_basemap).save(filename, compress_level=1)
+    return filename
+
+frame_name = re.compile(r'[0-9a-f]{64}\.png')
+
+def _frame_key(settings: bytes, d: str, *arrays: np.ndarray) -> str:
+    # frames are cached under a hash of that day's data and everything else that changes the picture
+    h = hashlib.sha256(settings)
+    h.update(d.encode())
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+def render_frames(frames: List[Tuple[str, pd.DataFrame]], panel: pd.DataFrame, basemap_path: Optional[str] = None, jobs: int = 1,
+                  cache_dir: str = 'frame_cache', bounds: Optional[Tuple[float, float, float, float]] = None) -> List[str]:
+    basemap, bounds = make_basemap(panel, basemap_path, bounds)
+    buf = io.BytesIO()
+    basemap.save(buf, format='PNG')
+    settings = repr(('pil', frame_version, frame_size, bounds)).encode() + hashlib.sha256(buf.getvalue()).digest()
+
+    paths = []
+    work = []
+    for d, df in frames:
+        bubbles = _bubbles(df)
+        path = os.path.join(cache_dir, '{}.png'.format(_frame_key(settings, d, *bubbles)))
+        paths.append(path)
+        if not os.path.exists(path):
+            work.append((d, *bubbles, path))
+
+    if work:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(buf.getvalue(), bounds)) as executor:
+            list(profiling.collect('make_gif.render_frame',
+                                   executor.map(profiling.timed(_render_png), work, chunksize=max(1, len(work) // (jobs * 4))),
+                                   ({'day': w[0]} for w in work)))
+    return paths
+
+def render_frames_bokeh(frames: List[Tuple[str, pd.DataFrame]], cache_dir: str = 'frame_cache') -> List[str]:
+    from bokeh.io import export_png
+    settings = repr(('bokeh', frame_version, frame_size)).encode()
+    paths = []
+    for d, df in frames:
+        path = os.path.join(cache_dir, '{}.png'.format(_frame_key(settings, d, pd.util.hash_pandas_object(df, index=False).to_numpy())))
+        paths.append(path)
+        if not os.path.exists(path):
+            with profiling.stage('make_gif.export_png', day=d):
+                export_png(plotday(d, df), filename=path)
+    return paths
+
+class GifWriter:
+    # Writes an animated GIF one frame at a time so memory doesn't grow with the number of frames.
+    # Only the region that changed since the previous frame is encoded, by Pillow as a single frame
+    # GIF, and spliced in with its palette as a local color table: https://www.w3.org/Graphics/GIF/spec-gif89a.txt
+    def __init__(self, fp_out: str, duration: int = 500, loop: int = 0):
+        self.fp = open(fp_out, 'wb')
+        self.duration = duration
+        self.loop = loop
+        self.previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, img: Image.Image):
+        img = img.convert('RGB')
+        if self.previous is None:
+            # logical screen without a global color table, then the looping extension
+            self.fp.write(b'GIF89a' + struct.pack('<HHBBB', img.size[0], img.size[1], 0, 0, 0))
+            self.fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self.loop) + b'\x00')
+            bbox = (0, 0) + img.size
+        else:
+            bbox = ImageChops.difference(self.previous, img).getbbox() or (0, 0, 1, 1)
+        self.previous = img
+
+        buf = io.BytesIO()
+        img.crop(bbox).quantize(method=Image.FASTOCTREE).save(buf, format='GIF')
+        data = buf.getvalue()
+        flags = data[10]
+        pos = 13
+        color_table = b''
+        if flags & 0x80:
+            color_table = data[pos:pos + 3 * (2 << (flags & 0x07))]
+            pos += len(color_table)
+        # skip Pillow's extensions up to the image descriptor
+        while data[pos] == 0x21:
+            pos += 2
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+
+        # graphic control extension: leave the frame in place for the next one to draw over
+        self.fp.write(b'!\xf9\x04\x04' + struct.pack('<H', self.duration // 10) + b'\x00\x00')
+        descriptor = bytearray(data[pos:pos + 10])
+        descriptor[1:5] = struct.pack('<HH', bbox[0], bbox[1])
+        if color_table and not descriptor[9] & 0x80:
+            descriptor[9] |= 0x80 | (flags & 0x07)
+            self.fp.write(bytes(descriptor) + color_table)
+        else:
+            self.fp.write(bytes(descriptor))
+        # the rest is the image data followed by the trailer
+        self.fp.write(data[pos + 10:data.rindex(b';')])
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.write(b';')
+            self.fp.close()
+
+class FfmpegWriter:
+    # Pipes frames to a local ffmpeg, the container and codec follow the extension of fp_out
+    def __init__(self, fp_out: str, duration: int = 500):
+        codec = ['-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '40'] if fp_out.endswith('.webm') else ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+        self.proc = subprocess.Popen(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'image2pipe', '-framerate', str(1000 / duration), '-i', '-']
+            + codec + ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', fp_out],
+            stdin=subprocess.PIPE
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, img: Image.Image):
+        img.convert('RGB').save(self.proc.stdin, format='PPM')
+
+    def close(self):
+        if self.proc.stdin.closed:
+            return
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError('ffmpeg exited with {}'.format(self.proc.returncode))
+
+def write_animation(paths: List[str], fp_out: str, duration: int = 500):
+    writer = GifWriter(fp_out, duration) if fp_out.endswith('.gif') else FfmpegWriter(fp_out, duration)
+    with writer:
+        for path in paths:
+            with profiling.stage('make_gif.encode_frame', file=path), Image.open(path) as img:
+                writer.append(img)
+
+def _parse_bounds(value: str) -> Tuple[float, float, float, float]:
+    try:
+        lon0, lat0, lon1, lat1 = (float(v) for v in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected lon0,lat0,lon1,lat1, got {!r}'.format(value))
+    if lon0 >= lon1 or lat0 >= lat1:
+        raise argparse.ArgumentTypeError('expected lon0 < lon1 and lat0 < lat1, got {!r}'.format(value))
+    return lon0, lat0, lon1, lat1
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Render active cases per school on a map into active_cases.gif')
+    parser.add_argument('--backend', choices=['pil', 'bokeh'], default='pil', help='pil draws frames without a browser, bokeh exports them through firefox')
+    parser.add_argument('--basemap', help='background image covering the schools, used by the pil backend')
+    parser.add_argument('--basemap-bounds', type=_parse_bounds, metavar='LON0,LAT0,LON1,LAT1',
+                        help='what --basemap covers, left, bottom, right and top in degrees; printed when not given')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of processes rendering frames with the pil backend')
+    parser.add_argument('-o', '--output', default='active_cases.gif', help='.gif, or .mp4/.webm encoded by a local ffmpeg')
+    parser.add_argument('--cache-dir', default='frame_cache', help='rendered frames are kept here and reused while their data is unchanged')
+    parser.add_argument('--db', default='cases.db', help='database built by parse.py')
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+    profiling_enabled = profiling.from_args(args)
+
+    with profiling.stage('make_gif.load_panel') as record, closing(sqlite3.connect(args.db)) as db_conn:
+        panel = load_panel(db_conn)
+        record['rows'] = len(panel)
+    frames = [(d.strftime('%Y-%m-%d'), df) for d, df in list(panel.groupby('Datestamp'))[1:]]
+    # each backend keeps its frames apart, so pruning after a run of one never touches the other's
+    cache_dir = os.path.join(args.cache_dir, args.backend)
+    os.makedirs(cache_dir, exist_ok=True)
+    with profiling.stage('make_gif.render_frames', backend=args.backend, frames=len(frames)):
+        if args.backend == 'bokeh':
+            paths = render_frames_bokeh(frames, cache_dir)
+        else:
+            if args.basemap is not None and args.basemap_bounds is None:
+                print('basemap bounds: --basemap-bounds={:.6f},{:.6f},{:.6f},{:.6f}'.format(*basemap_bounds(panel)))
+            paths = render_frames(frames, panel, args.basemap, args.jobs, cache_dir, args.basemap_bounds)
+
+    with profiling.stage('make_gif.write_animation', output=args.output, frames=len(paths)):
+        write_animation(paths, args.output)
+
+    # drop frames nothing refers to anymore so the cache doesn't grow without bound,
+    # only files named like a frame key so other pngs in the directory are left alone
+    keep = set(paths)
+    for name in os.listdir(cache_dir):
+        f = os.path.join(cache_dir, name)
+        if frame_name.fullmatch(name) and f not in keep:
+            os.unlink(f)
+    if profiling_enabled:
+        profiling.disable()
     print("finished")
 
 if __name__ == '__main__':
@@ -1,35 +1,68 @@
 import sqlite3
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+import argparse
+import cube
+import hashlib
 import os
+import profiling
+import time
 
-def parse(path: str, d: date) -> List[Dict[str, str]]:
+def iter_parse(path: str, d: date) -> Iterator[tuple]:
     with open(path, 'r') as f:
-        lines = f.readlines()
+        yield from iter_parse_lines(f, d, path)
 
-    records = []
+def iter_parse_lines(lines: Iterable[str], d: date, path: str = '<snapshot>') -> Iterator[tuple]:
+    d_str = d.isoformat()
+    lines = iter(lines)
     # first line is the quarantine data for that day
-    students_quarantined, staff_quarantined = lines[0].strip().split(',')
-    records.append({'Date': d.isoformat(), 'Students_Quarantined': students_quarantined, 'Staff_Quarantined': staff_quarantined})
+    students_quarantined, staff_quarantined = next(lines).strip().split(',')
+    yield (d_str, students_quarantined, staff_quarantined)
 
-    # remaining lines are per-school case data
-    for i in range(1, len(lines), 5):
+    # remaining lines are per-school case data, 5 lines per school
+    lineno = 2
+    while True:
+        block = list(islice(lines, 5))
+        if not block:
+            break
         try:
-            rec = {
-                'Date': d.isoformat(),
-                'Primary_Location': lines[i].strip(),
-                'Active_Student': int(lines[i+1].strip()),
-                'Total_Student': int(lines[i+2].strip()),
-                'Active_Staff': int(lines[i+3].strip()),
-                'Total_Staff': int(lines[i+4].strip())
-            }
+            yield (block[0].strip(), d_str, int(block[1]), int(block[2]), int(block[3]), int(block[4]))
         except Exception as e:
-            print('exception at {}:{}'.format(path, i+1))
+            print('exception at {}:{}'.format(path, lineno))
             raise
+        lineno += 5
 
-        records.append(rec)
+def parse(path: str, d: date) -> List[Dict[str, str]]:
+    rows = iter_parse(path, d)
+    date_str, students_quarantined, staff_quarantined = next(rows)
+    records = [{'Date': date_str, 'Students_Quarantined': students_quarantined, 'Staff_Quarantined': staff_quarantined}]
+    for school, _, active_student, total_student, active_staff, total_staff in rows:
+        records.append({
+            'Date': date_str,
+            'Primary_Location': school,
+            'Active_Student': active_student,
+            'Total_Student': total_student,
+            'Active_Staff': active_staff,
+            'Total_Staff': total_staff
+        })
     return records
 
+def _split(rows: Iterator[tuple]) -> Tuple[tuple, Iterator[tuple]]:
+    return next(rows), rows
+
+def _parse_file(args: Tuple[str, date]) -> Tuple[tuple, List[tuple]]:
+    rows = iter_parse(*args)
+    return next(rows), list(rows)
+
+def _parse_file_profiled(args: Tuple[str, date]) -> Tuple[tuple, List[tuple]]:
+    with profiling.stage('parse.parse_file', file=args[0]) as record:
+        quarantine_row, case_rows = _parse_file(args)
+        record['rows'] = len(case_rows)
+    return quarantine_row, case_rows
+
 def create_tables(db_conn):
     c = db_conn.cursor()
 
@@ -57,6 +90,11 @@ def create_tables(db_conn):
         """
     )
 
+    # answer a school's history or a whole day from the index alone (query.Queries, cube.write_cube); the primary
+    # key orders the same columns as the first one but would go back to the table for the counters
+    c.execute('CREATE INDEX IF NOT EXISTS cases_School_covering ON cases(School, Datestamp, Active_Student, Total_Student, Active_Staff, Total_Staff)')
+    c.execute('CREATE INDEX IF NOT EXISTS cases_Datestamp_covering ON cases(Datestamp, School, Active_Student, Total_Student, Active_Staff, Total_Staff)')
+
     c.execute(
         """
         CREATE TABLE IF NOT EXISTS school_level (
@@ -69,6 +107,8 @@ def create_tables(db_conn):
         """
     )
 
+    c.execute('CREATE INDEX IF NOT EXISTS school_level_Level ON school_level(Level, School, Students)')
+
     c.execute(
         """
         CREATE TABLE IF NOT EXISTS dates (
@@ -77,39 +117,200 @@ def create_tables(db_conn):
         """
     )
 
+    c.execute('CREATE INDEX IF NOT EXISTS dates_Datestamp ON dates(Datestamp)')
+
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS manifest (
+            Datestamp TEXT    NOT NULL PRIMARY KEY,
+            Size      INTEGER NOT NULL,
+            Mtime     REAL    NOT NULL,
+            Hash      TEXT    NOT NULL
+        )
+        """
+    )
+
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS daily_summary (
+            Datestamp            TEXT    NOT NULL PRIMARY KEY,
+            Active_Student       INTEGER,
+            Total_Student        INTEGER,
+            Active_Staff         INTEGER,
+            Total_Staff          INTEGER,
+            Quarantined_Students INTEGER,
+            Quarantined_Staff    INTEGER
+        )
+        """
+    )
+
     db_conn.commit()
 
-def main():
-    db_conn = sqlite3.connect('cases.db')
+def loaded_dates(db_conn) -> Set[str]:
+    return {row[0] for row in db_conn.execute('SELECT Datestamp FROM dates')}
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def bump_version(db_conn):
+    # tells readers caching query results (query.Queries) that the data changed
+    version = db_conn.execute('PRAGMA user_version').fetchone()[0]
+    db_conn.execute('PRAGMA user_version = {}'.format(version + 1))
+
+def update_summary(db_conn, dates: List[str]):
+    # the dates also include any loaded day missing from daily_summary, e.g. in a database built before it existed
+    db_conn.execute('CREATE TEMP TABLE IF NOT EXISTS summary_dates (Datestamp TEXT NOT NULL PRIMARY KEY)')
+    db_conn.execute('DELETE FROM summary_dates')
+    db_conn.executemany('INSERT OR IGNORE INTO summary_dates VALUES(?)', [(d, ) for d in dates])
+    db_conn.execute('INSERT OR IGNORE INTO summary_dates SELECT Datestamp FROM dates WHERE Datestamp NOT IN (SELECT Datestamp FROM daily_summary)')
+
+    # a reloaded day may have no case rows left, its old sums must not survive
+    db_conn.execute('DELETE FROM daily_summary WHERE Datestamp IN (SELECT Datestamp FROM summary_dates)')
+    db_conn.execute(
+        """
+        INSERT INTO daily_summary(Datestamp, Active_Student, Total_Student, Active_Staff, Total_Staff, Quarantined_Students, Quarantined_Staff)
+        SELECT case_summary.Datestamp, Active_Student, Total_Student, Active_Staff, Total_Staff, quarantines.Students, quarantines.Staff
+        FROM (
+          SELECT Datestamp,
+                 SUM(Active_Student) AS Active_Student,
+                 SUM(Total_Student) AS Total_Student,
+                 SUM(Active_Staff) AS Active_Staff,
+                 SUM(Total_Staff) AS Total_Staff
+          FROM cases
+          WHERE Datestamp IN (SELECT Datestamp FROM summary_dates)
+          GROUP BY Datestamp
+        ) AS case_summary
+        LEFT JOIN quarantines USING(Datestamp)
+        """
+    )
+
+def changed_files(db_conn, directory: str = '.') -> List[Tuple[date, str, Tuple[int, float, str]]]:
+    manifest = {row[0]: row[1:] for row in db_conn.execute('SELECT Datestamp, Size, Mtime, Hash FROM manifest')}
+    changed = []
+    touched = []
+    for path in sorted(os.listdir(directory)):
+        if not path.startswith('data_'):
+            continue
+        d_str = path[5:]
+        full_path = os.path.join(directory, path)
+        st = os.stat(full_path)
+        known = manifest.get(d_str)
+        # size and mtime unchanged, don't bother reading the file
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime:
+            continue
+        digest = file_hash(full_path)
+        if known is not None and known[2] == digest:
+            touched.append((st.st_size, st.st_mtime, d_str))
+            continue
+        changed.append((date.fromisoformat(d_str), full_path, (st.st_size, st.st_mtime, digest)))
+
+    if touched:
+        with db_conn:
+            db_conn.executemany('UPDATE manifest SET Size=?, Mtime=? WHERE Datestamp=?', touched)
+    return changed
+
+def load_days(db_conn, days: Iterable[Tuple[date, Tuple[int, float, str], tuple, Iterable[tuple]]]) -> int:
+    # days are (date, (size, mtime, hash), quarantine row, case rows) for the snapshots that changed
+    loaded = loaded_dates(db_conn)
+    changed = []
+    rows = 0
+    # load everything in one transaction so a re-run only pays for the changed files
+    with db_conn:
+        for d, (size, mtime, digest), quarantine_row, case_rows in days:
+            d_str = d.isoformat()
+            with profiling.stage('parse.insert_day', day=d_str) as record:
+                if d_str in loaded:
+                    # the snapshot was corrected after it was loaded, replace that day's rows
+                    db_conn.execute('DELETE FROM quarantines WHERE Datestamp=?', (d_str, ))
+                    db_conn.execute('DELETE FROM cases WHERE Datestamp=?', (d_str, ))
+                else:
+                    db_conn.execute('INSERT INTO dates VALUES(?)', (d_str, ))
+                # After Jan 10, 2022 they stopped publishing the quarantine data
+                if d < date(2022, 1, 11):
+                    db_conn.execute('INSERT INTO quarantines VALUES(?, ?, ?)', quarantine_row)
+                    rows += 1
+                record['rows'] = db_conn.executemany('INSERT INTO cases VALUES(?, ?, ?, ?, ?, ?)', case_rows).rowcount
+                rows += record['rows']
+                db_conn.execute('INSERT OR REPLACE INTO manifest VALUES(?, ?, ?, ?)', (d_str, size, mtime, digest))
+                changed.append(d_str)
+
+        with profiling.stage('parse.update_summary', days=len(changed)):
+            update_summary(db_conn, changed)
+        if changed:
+            bump_version(db_conn)
+
+    return rows
+
+def ingest(db_conn, directory: str = '.', jobs: int = 1) -> int:
+    with profiling.stage('parse.changed_files') as record:
+        changed = changed_files(db_conn, directory)
+        record['files'] = len(changed)
+    work = [(path, d) for d, path, _ in changed]
+
+    with (ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext()) as executor:
+        if executor is not None:
+            # executor.map hands the results back in date order
+            parsed = profiling.collect('parse.parse_file',
+                                       executor.map(profiling.timed(_parse_file), work, chunksize=max(1, len(work) // (jobs * 4))),
+                                       ({'file': path} for path, _ in work))
+        elif profiling.enabled():
+            parsed = map(_parse_file_profiled, work)
+        else:
+            parsed = (_split(iter_parse(*w)) for w in work)
+
+        return load_days(db_conn, ((d, meta, quarantine_row, case_rows) for (d, _, meta), (quarantine_row, case_rows) in zip(changed, parsed)))
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Load the data_* snapshots into cases.db')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to parse the snapshots')
+    parser.add_argument('--archive', help='load the snapshots from this archive (see archive.py) instead of the data_* files')
+    parser.add_argument('--cube-dir', default='cube', help='where the memory-mapped school x date arrays are written')
+    parser.add_argument('--db', default='cases.db', help='database to create or update')
+    profiling.add_arguments(parser)
+    args = parser.parse_args(argv)
+    profiling_enabled = profiling.from_args(args)
+
+    db_conn = sqlite3.connect(args.db)
+    db_conn.execute('PRAGMA journal_mode=WAL')
+    db_conn.execute('PRAGMA synchronous=NORMAL')
     create_tables(db_conn)
 
-    dates = [date.fromisoformat(path[5:]) for path in os.listdir('.') if path.startswith('data_')]
-    for d in dates:
-        cur = db_conn.execute("SELECT COUNT(*) FROM dates WHERE Datestamp=(?)", (d.isoformat(), ))
-        if cur.fetchone()[0] == 0:
-            datafile_path = 'data_{}'.format(d.isoformat())
-            parsed = parse(datafile_path, d)
-            # After Jan 10, 2022 they stopped publishing the quarantine data
-            if d < date(2022, 1, 11):
-                db_conn.execute('INSERT INTO quarantines VALUES(:Date, :Students_Quarantined, :Staff_Quarantined)', parsed[0])
-            db_conn.executemany('INSERT INTO cases VALUES(:Primary_Location, :Date, :Active_Student, :Total_Student, :Active_Staff, :Total_Staff)', parsed[1:])
-            db_conn.execute('INSERT INTO dates VALUES(?)', (d.isoformat(), ))
-    
-    db_conn.commit()
+    start = time.perf_counter()
+    with profiling.stage('parse.ingest') as record:
+        if args.archive:
+            import archive
+            rows = archive.ingest(db_conn, args.archive)
+        else:
+            rows = ingest(db_conn, jobs=args.jobs)
+        record['rows'] = rows
+    elapsed = time.perf_counter() - start
+    print('loaded {} rows in {:.3f}s ({:.0f} rows/sec)'.format(rows, elapsed, rows / elapsed if elapsed > 0 else 0))
 
     with open('school_list_geo', 'r') as f:
         schools_lines = f.readlines()
     schools = [[None if a == '' else a for a in x.strip().split(',')] for x in schools_lines]
-    db_conn.executemany('INSERT OR IGNORE INTO school_level VALUES(?, ?, ?, ?, ?)', schools)
+    new_schools = db_conn.executemany('INSERT OR IGNORE INTO school_level VALUES(?, ?, ?, ?, ?)', schools).rowcount
+    if new_schools:
+        bump_version(db_conn)
 
     db_conn.commit()
 
+    # only rewrites the days that changed, and repairs the cube if an earlier run didn't finish it
+    with profiling.stage('parse.write_cube'):
+        cube.write_cube(db_conn, args.cube_dir)
+
     curr = db_conn.execute("SELECT DISTINCT cases.School FROM cases LEFT JOIN school_level USING(School) WHERE school_level.Level IS NULL")
     unaccounted_schools = curr.fetchall()
     if (len(unaccounted_schools) > 0):
         print('Schools not in school list: ', ', '.join([x[0] for x in unaccounted_schools]))
 
     db_conn.close()
+    if profiling_enabled:
+        profiling.disable()
 
 if __name__ == '__main__':
     main()
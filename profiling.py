@@ -0,0 +1,177 @@
+import atexit
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from functools import partial, wraps
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+# Opt-in stage timings for parse.py, techniques.py and make_gif.py. With --profile every stage is written
+# as one JSON object per line to <prefix>.jsonl:
+#
+#   {"stage": "parse.insert_day", "day": "2021-12-01", "start_s": 1.2, "wall_s": 0.004, "cpu_s": 0.004, "rows": 191, "parent": "parse.ingest"}
+#
+# --profile-memory adds the stage's allocation peak above what was allocated when it started
+# ("peak_alloc_bytes", tracemalloc, main process only) and dumps a snapshot to <prefix>.tracemalloc,
+# --profile-cprofile dumps the whole run to <prefix>.prof for pstats/snakeviz.
+#
+# While profiling is off stage() hands back a shared no-op context manager.
+
+class _Stage:
+    __slots__ = ('profiler', 'record', 'wall', 'cpu', 'current', 'peak')
+
+    def __init__(self, profiler: 'Profiler', record: Dict[str, object]):
+        self.profiler = profiler
+        self.record = record
+
+    def __enter__(self) -> Dict[str, object]:
+        # the body can add to the record, e.g. the number of rows it handled
+        self.profiler.enter(self)
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+        return self.record
+
+    def __exit__(self, *exc):
+        self.record['wall_s'] = time.perf_counter() - self.wall
+        self.record['cpu_s'] = time.process_time() - self.cpu
+        self.profiler.exit(self)
+        return False
+
+class _NoStage:
+    def __enter__(self) -> Dict[str, object]:
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+_no_stage = _NoStage()
+
+class Profiler:
+    def __init__(self, prefix: str = 'profile', memory: bool = False, cprofile: bool = False):
+        self.prefix = prefix
+        self.log = open(prefix + '.jsonl', 'w')
+        self.memory = memory
+        self.stack: List[_Stage] = []
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+        self.peak = 0
+        if memory:
+            tracemalloc.start()
+        self.cprofile = cProfile.Profile() if cprofile else None
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def enter(self, stage: _Stage):
+        stage.record['start_s'] = time.perf_counter() - self.start
+        if self.stack:
+            stage.record['parent'] = self.stack[-1].record['stage']
+        if self.memory:
+            # the peak is global, fold it into the enclosing stage before resetting it for this one
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1].peak = max(self.stack[-1].peak, peak)
+            else:
+                self.peak = max(self.peak, peak)
+            tracemalloc.reset_peak()
+            stage.current, stage.peak = current, current
+        self.stack.append(stage)
+
+    def exit(self, stage: _Stage):
+        self.stack.pop()
+        if self.memory:
+            stage.peak = max(stage.peak, tracemalloc.get_traced_memory()[1])
+            stage.record['peak_alloc_bytes'] = stage.peak - stage.current
+            if self.stack:
+                self.stack[-1].peak = max(self.stack[-1].peak, stage.peak)
+            else:
+                self.peak = max(self.peak, stage.peak)
+        self.write(stage.record)
+
+    def write(self, record: Dict[str, object]):
+        self.log.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.log.closed:
+            return
+        record = {'stage': 'total', 'start_s': 0.0, 'wall_s': time.perf_counter() - self.start, 'cpu_s': time.process_time() - self.cpu}
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.prefix + '.prof')
+        if self.memory:
+            record['peak_alloc_bytes'] = max(self.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.take_snapshot().dump(self.prefix + '.tracemalloc')
+            tracemalloc.stop()
+        self.write(record)
+        self.log.close()
+
+_profiler: Optional[Profiler] = None
+
+def enable(prefix: str = 'profile', memory: bool = False, cprofile: bool = False) -> Profiler:
+    global _profiler
+    disable()
+    _profiler = Profiler(prefix, memory, cprofile)
+    atexit.register(disable)
+    return _profiler
+
+def disable():
+    global _profiler
+    if _profiler is not None:
+        _profiler.close()
+        _profiler = None
+
+def enabled() -> bool:
+    return _profiler is not None
+
+def stage(name: str, **fields):
+    # with stage('parse.ingest') as record: ... record['rows'] = n
+    if _profiler is None:
+        return _no_stage
+    return _Stage(_profiler, dict(stage=name, **fields))
+
+def profiled(name: str) -> Callable:
+    # decorator recording every call of the function as a stage
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _Stage(_profiler, {'stage': name}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _timed_call(fn: Callable, args):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = fn(args)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+def timed(fn: Callable) -> Callable:
+    # wraps fn, to be run in worker processes by executor.map, so that it also returns the time it took; see collect()
+    return fn if _profiler is None else partial(_timed_call, fn)
+
+def collect(name: str, results: Iterable, fields: Iterable[Dict[str, object]]) -> Iterator:
+    # records each result of a timed() fn as a stage with the matching fields and yields fn's own results
+    if _profiler is None:
+        yield from results
+        return
+    parent = _profiler.stack[-1].record['stage'] if _profiler.stack else None
+    for (result, wall, cpu), extra in zip(results, fields):
+        record = dict(stage=name, **extra, start_s=time.perf_counter() - _profiler.start - wall, wall_s=wall, cpu_s=cpu, worker=True)
+        if parent is not None:
+            record['parent'] = parent
+        _profiler.write(record)
+        yield result
+
+def add_arguments(parser):
+    parser.add_argument('--profile', action='store_true', help='write per stage timings as JSON lines to <prefix>.jsonl')
+    parser.add_argument('--profile-prefix', default='profile', help='where the profiling output goes, default profile.*')
+    parser.add_argument('--profile-memory', action='store_true', help='also record allocation peaks with tracemalloc and dump a snapshot (slower)')
+    parser.add_argument('--profile-cprofile', action='store_true', help='also dump a cProfile of the whole run to <prefix>.prof')
+
+def from_args(args) -> bool:
+    # any of the --profile-* switches turns profiling on, returns whether it did so the caller knows to disable() it
+    if not (args.profile or args.profile_memory or args.profile_cprofile):
+        return False
+    os.makedirs(os.path.dirname(args.profile_prefix) or '.', exist_ok=True)
+    enable(args.profile_prefix, args.profile_memory, args.profile_cprofile)
+    return True
@@ -0,0 +1,89 @@
+import sqlite3
+from functools import lru_cache
+from typing import Tuple
+
+# Cached lookups on cases.db for the dashboard:
+#
+#   queries = query.Queries(db_conn)
+#   queries.school_series('Annapolis High')      ((Datestamp, Active_Student, Total_Student, Active_Staff, Total_Staff), ...)
+#   queries.level_series('High')                 ((Datestamp, sum of Active_Student over the High schools), ...)
+#   queries.top_schools('2022-01-04', 10)        ((School, Active_Student), ...) largest first
+#
+# Every query is answered without touching the tables, from the covering indexes parse.create_tables()
+# adds on cases by (School, Datestamp, counters) and (Datestamp, School, counters) and on school_level
+# by Level. Results are tuples kept in an LRU cache until parse.py loads new or corrected days or new
+# schools, which it signals by bumping PRAGMA user_version.
+
+METRICS = ['Active_Student', 'Total_Student', 'Active_Staff', 'Total_Staff']
+
+def _check_metric(metric: str):
+    # metrics are spliced into the SQL, only allow the column names
+    if metric not in METRICS:
+        raise ValueError('unknown metric {}, expected one of {}'.format(metric, METRICS))
+
+class Queries:
+    def __init__(self, db_conn: sqlite3.Connection, maxsize: int = 1024):
+        self.db_conn = db_conn
+        self._version = None
+        self._school_series = lru_cache(maxsize)(self._query_school_series)
+        self._level_series = lru_cache(maxsize)(self._query_level_series)
+        self._top_schools = lru_cache(maxsize)(self._query_top_schools)
+
+    def _refresh(self):
+        # one pragma read per call, the caches are dropped whenever the data changed
+        version = self.db_conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self._version:
+            self.cache_clear()
+            self._version = version
+
+    def cache_clear(self):
+        self._school_series.cache_clear()
+        self._level_series.cache_clear()
+        self._top_schools.cache_clear()
+
+    def school_series(self, school: str) -> Tuple[Tuple[str, int, int, int, int], ...]:
+        self._refresh()
+        return self._school_series(school)
+
+    def level_series(self, level: str, metric: str = 'Active_Student') -> Tuple[Tuple[str, int], ...]:
+        _check_metric(metric)
+        self._refresh()
+        return self._level_series(level, metric)
+
+    def top_schools(self, d: str, n: int = 10, metric: str = 'Active_Student') -> Tuple[Tuple[str, int], ...]:
+        _check_metric(metric)
+        self._refresh()
+        return self._top_schools(d, n, metric)
+
+    def _query_school_series(self, school: str):
+        return tuple(self.db_conn.execute(
+            '''
+            SELECT Datestamp, Active_Student, Total_Student, Active_Staff, Total_Staff
+            FROM cases
+            WHERE School = ?
+            ORDER BY Datestamp
+            ''', (school, )
+        ))
+
+    def _query_level_series(self, level: str, metric: str):
+        return tuple(self.db_conn.execute(
+            '''
+            SELECT cases.Datestamp, SUM(cases.{})
+            FROM school_level
+            JOIN cases USING(School)
+            WHERE school_level.Level = ?
+            GROUP BY cases.Datestamp
+            ORDER BY cases.Datestamp
+            '''.format(metric), (level, )
+        ))
+
+    def _query_top_schools(self, d: str, n: int, metric: str):
+        return tuple(self.db_conn.execute(
+            '''
+            SELECT School, {0}
+            FROM cases
+            WHERE Datestamp = ?
+            ORDER BY {0} DESC, School
+            LIMIT ?
+            '''.format(metric), (d, n)
+        ))
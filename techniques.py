@@ -1,9 +1,156 @@
 import pandas as pd
 import sqlite3
 import numpy as np
+import profiling
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
 
-def summarize(db_conn: sqlite3.Connection, total_students: int):
+SUMMARY_COLUMNS = [
+    'Active Student Cases', 'Total Student Cases', 'Active Staff Cases', 'Total Staff Cases',
+    'Quarantined Students', 'Quarantined Staff',
+    'Student Quarantine Factor', 'Staff Quarantine Factor',
+    'Change in Students Quarantined', '% Change in Students Quarantined', '% Students Quarantined',
+    'Change in Active Student Cases', '% Change in Active Student Cases', '% Students with Active Cases',
+    'Change in Total Student Cases', '% Change in Total Student Cases', '% of Students in Total Student Cases',
+    'Student Cases Resolved', 'Student Cases Newly Resolved', 'New Student Cases',
+    'Change in Staff Quarantined', '% Change in Staff Quarantined',
+    'Change in Active Staff Cases', '% Change in Active Staff Cases',
+    'Change in Total Staff Cases', '% Change in Total Staff Cases',
+    'Staff Cases Resolved', 'Staff Cases Newly Resolved', 'New Staff Cases'
+]
+
+# the per day sums both summaries start from, derive_metrics() computes the other columns
+_SUM_DTYPES = {'Active Student Cases': np.int32, 'Total Student Cases': np.int32, 'Active Staff Cases': np.int32, 'Total Staff Cases': np.int32}
+
+def _summary_complete(db_conn: sqlite3.Connection) -> bool:
+    # daily_summary is missing or behind in a database written by an older parse.py that hasn't been re-run
+    # (a loaded day without any case rows has no summary row either)
+    try:
+        missing = db_conn.execute('''
+        SELECT EXISTS(
+          SELECT 1 FROM dates
+          WHERE Datestamp NOT IN (SELECT Datestamp FROM daily_summary)
+            AND EXISTS(SELECT 1 FROM cases WHERE cases.Datestamp = dates.Datestamp)
+        )
+        ''').fetchone()[0]
+    except sqlite3.OperationalError:
+        return False
+    return not missing
+
+@profiling.profiled('techniques.summarize')
+def summarize(db_conn: sqlite3.Connection, total_students: int, recompute: bool = False):
+    if recompute or not _summary_complete(db_conn):
+        df_summary = _summarize_cases(db_conn)
+    else:
+        # daily_summary is kept up to date by parse.main() as new dates are ingested
+        df_summary = pd.read_sql_query('''
+        SELECT Datestamp,
+               Active_Student AS "Active Student Cases",
+               Total_Student AS "Total Student Cases",
+               Active_Staff AS "Active Staff Cases",
+               Total_Staff AS "Total Staff Cases",
+               Quarantined_Students AS "Quarantined Students",
+               Quarantined_Staff AS "Quarantined Staff"
+        FROM daily_summary
+        ORDER BY Datestamp;
+        ''', db_conn, index_col='Datestamp', parse_dates='Datestamp',
+        dtype=_SUM_DTYPES
+        )
+
+    # either way only the sums are read, everything else comes from the metric engine
+    df_summary = derive_metrics(df_summary, total_students)
+
+    return df_summary[SUMMARY_COLUMNS]
+
+# Declarative spec of the derived summary columns as (column, kind, inputs).
+# Each kind is evaluated for all of its columns at once on a 2-D array, with
+# every input lagged a single time:
+#   change          x - lag(x)
+#   pct_change      (x - lag(x)) / lag(x) * 100
+#   pct_of_students x / total_students * 100
+#   ratio           x / y
+#   resolved        x - y, for (total, active)
+#   newly_resolved  resolved - lag(resolved), for (total, active)
+#   new             active - (lag(active) - newly_resolved), for (total, active)
+METRICS = [
+    ('Student Quarantine Factor', 'ratio', ('Quarantined Students', 'Active Student Cases')),
+    ('Staff Quarantine Factor', 'ratio', ('Quarantined Staff', 'Active Staff Cases')),
+    ('Change in Students Quarantined', 'change', ('Quarantined Students', )),
+    ('% Change in Students Quarantined', 'pct_change', ('Quarantined Students', )),
+    ('% Students Quarantined', 'pct_of_students', ('Quarantined Students', )),
+    ('Change in Active Student Cases', 'change', ('Active Student Cases', )),
+    ('% Change in Active Student Cases', 'pct_change', ('Active Student Cases', )),
+    ('% Students with Active Cases', 'pct_of_students', ('Active Student Cases', )),
+    ('Change in Total Student Cases', 'change', ('Total Student Cases', )),
+    ('% Change in Total Student Cases', 'pct_change', ('Total Student Cases', )),
+    ('% of Students in Total Student Cases', 'pct_of_students', ('Total Student Cases', )),
+    ('Student Cases Resolved', 'resolved', ('Total Student Cases', 'Active Student Cases')),
+    ('Student Cases Newly Resolved', 'newly_resolved', ('Total Student Cases', 'Active Student Cases')),
+    ('New Student Cases', 'new', ('Total Student Cases', 'Active Student Cases')),
+    ('Change in Staff Quarantined', 'change', ('Quarantined Staff', )),
+    ('% Change in Staff Quarantined', 'pct_change', ('Quarantined Staff', )),
+    ('Change in Active Staff Cases', 'change', ('Active Staff Cases', )),
+    ('% Change in Active Staff Cases', 'pct_change', ('Active Staff Cases', )),
+    ('Change in Total Staff Cases', 'change', ('Total Staff Cases', )),
+    ('% Change in Total Staff Cases', 'pct_change', ('Total Staff Cases', )),
+    ('Staff Cases Resolved', 'resolved', ('Total Staff Cases', 'Active Staff Cases')),
+    ('Staff Cases Newly Resolved', 'newly_resolved', ('Total Staff Cases', 'Active Staff Cases')),
+    ('New Staff Cases', 'new', ('Total Staff Cases', 'Active Staff Cases'))
+]
+
+# kinds that stay integer when their inputs are
+_INTEGER_KINDS = {'change', 'resolved', 'newly_resolved', 'new'}
+
+def _evaluate(kind: str, x: np.ndarray, lx: np.ndarray, y: np.ndarray, ly: np.ndarray, total_students: int) -> np.ndarray:
+    if kind == 'change':
+        return x - lx
+    if kind == 'pct_change':
+        return (x - lx) / lx * 100
+    if kind == 'pct_of_students':
+        return x / total_students * 100
+    if kind == 'ratio':
+        return x / y
+    if kind == 'resolved':
+        return x - y
+    newly_resolved = (x - y) - (lx - ly)
+    if kind == 'newly_resolved':
+        return newly_resolved
+    if kind == 'new':
+        return y - (ly - newly_resolved)
+    raise ValueError('unknown metric kind {}'.format(kind))
+
+@profiling.profiled('techniques.derive_metrics')
+def derive_metrics(df_summary: pd.DataFrame, total_students: int, metrics=METRICS) -> pd.DataFrame:
+    metrics = [m for m in metrics if m[0] not in df_summary.columns]
+    if not metrics:
+        return df_summary
+
+    inputs = list(dict.fromkeys(col for _, _, cols in metrics for col in cols))
+    position = {col: i for i, col in enumerate(inputs)}
+    values = df_summary[inputs].to_numpy(dtype=np.float64)
+    lagged = np.zeros_like(values)
+    lagged[1:] = values[:-1]
+
+    frames = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for kind in dict.fromkeys(kind for _, kind, _ in metrics):
+            group = [m for m in metrics if m[1] == kind]
+            xi = [position[cols[0]] for _, _, cols in group]
+            yi = [position[cols[-1]] for _, _, cols in group]
+            block = _evaluate(kind, values[:, xi], lagged[:, xi], values[:, yi], lagged[:, yi], total_students)
+            frame = pd.DataFrame(block, index=df_summary.index, columns=[name for name, _, _ in group])
+            if kind in _INTEGER_KINDS:
+                for name, _, cols in group:
+                    dtypes = [df_summary[col].dtype for col in cols]
+                    if all(np.issubdtype(t, np.integer) for t in dtypes):
+                        frame[name] = frame[name].astype(np.result_type(*dtypes))
+            frames.append(frame)
+
+    return pd.concat([df_summary] + frames, axis=1)
+
+@profiling.profiled('techniques.summarize_cases')
+def _summarize_cases(db_conn: sqlite3.Connection):
     df_summary = pd.read_sql_query('''
     SELECT * FROM (
       SELECT Datestamp,
@@ -21,32 +168,8 @@ def summarize(db_conn: sqlite3.Connection, total_students: int):
       FROM quarantines
     ) USING(Datestamp);
     ''', db_conn, index_col='Datestamp', parse_dates='Datestamp',
-    dtype={'Active Student Cases': np.int32, 'Total Student Cases': np.int32, 'Active Staff Cases': np.int32, 'Total Staff Cases': np.int32}
+    dtype=_SUM_DTYPES
     )
-    df_summary['Student Quarantine Factor'] = df_summary['Quarantined Students'] / df_summary['Active Student Cases']
-    df_summary['Staff Quarantine Factor'] = df_summary['Quarantined Staff'] / df_summary['Active Staff Cases']
-    df_summary['Change in Students Quarantined'] = df_summary['Quarantined Students'] - df_summary['Quarantined Students'].shift(1, fill_value=0)
-    df_summary['% Change in Students Quarantined'] = (df_summary['Quarantined Students'] - df_summary['Quarantined Students'].shift(1, fill_value=0)) / df_summary['Quarantined Students'].shift(1, fill_value=0) * 100
-    df_summary['% Students Quarantined'] = (df_summary['Quarantined Students'] / total_students) * 100
-    df_summary['Change in Active Student Cases'] = df_summary['Active Student Cases'] - df_summary['Active Student Cases'].shift(1, fill_value=0)
-    df_summary['% Change in Active Student Cases'] = (df_summary['Active Student Cases'] - df_summary['Active Student Cases'].shift(1, fill_value=0)) / df_summary['Active Student Cases'].shift(1, fill_value=0) * 100
-    df_summary['% Students with Active Cases'] = df_summary['Active Student Cases'] / total_students * 100
-    df_summary['Change in Total Student Cases'] = df_summary['Total Student Cases'] - df_summary['Total Student Cases'].shift(1, fill_value=0)
-    df_summary['% Change in Total Student Cases'] = (df_summary['Total Student Cases'] - df_summary['Total Student Cases'].shift(1, fill_value=0)) / df_summary['Total Student Cases'].shift(1, fill_value=0) * 100
-    df_summary['% of Students in Total Student Cases'] = df_summary['Total Student Cases'] / total_students * 100
-    df_summary['Student Cases Resolved'] = df_summary['Total Student Cases'] - df_summary['Active Student Cases']
-    df_summary['Student Cases Newly Resolved'] = df_summary['Student Cases Resolved'] - df_summary['Student Cases Resolved'].shift(1, fill_value=0)
-    df_summary['New Student Cases'] = df_summary['Active Student Cases'] - (df_summary['Active Student Cases'].shift(1, fill_value=0) - df_summary['Student Cases Newly Resolved'])
-    df_summary['Change in Staff Quarantined'] = df_summary['Quarantined Staff'] - df_summary['Quarantined Staff'].shift(1, fill_value=0)
-    df_summary['% Change in Staff Quarantined'] = (df_summary['Quarantined Staff'] - df_summary['Quarantined Staff'].shift(1, fill_value=0)) / df_summary['Quarantined Staff'].shift(1, fill_value=0) * 100
-    df_summary['Change in Active Staff Cases'] = df_summary['Active Staff Cases'] - df_summary['Active Staff Cases'].shift(1, fill_value=0)
-    df_summary['% Change in Active Staff Cases'] = (df_summary['Active Staff Cases'] - df_summary['Active Staff Cases'].shift(1, fill_value=0)) / df_summary['Active Staff Cases'].shift(1, fill_value=0) * 100
-    df_summary['Change in Total Staff Cases'] = df_summary['Total Staff Cases'] - df_summary['Total Staff Cases'].shift(1, fill_value=0)
-    df_summary['% Change in Total Staff Cases'] = (df_summary['Total Staff Cases'] - df_summary['Total Staff Cases'].shift(1, fill_value=0)) / df_summary['Total Staff Cases'].shift(1, fill_value=0) * 100
-    df_summary['Staff Cases Resolved'] = df_summary['Total Staff Cases'] - df_summary['Active Staff Cases']
-    df_summary['Staff Cases Newly Resolved'] = df_summary['Staff Cases Resolved'] - df_summary['Staff Cases Resolved'].shift(1, fill_value=0)
-    df_summary['New Staff Cases'] = df_summary['Active Staff Cases'] - (df_summary['Active Staff Cases'].shift(1, fill_value=0) - df_summary['Staff Cases Newly Resolved'])
-
     return df_summary
 
 class Model3:
@@ -60,11 +183,13 @@ class Model3:
                  pct_long_covid: float = 0,
                  pct_severe: float = 0,
                  pct_death: float = 0,
-                 quarantine_period: int = 0):
+                 quarantine_period: int = 0,
+                 replicates: int = 1000,
+                 seed: Optional[int] = None):
         if start_date not in df_summary.index:
             raise IndexError
 
-        self.start_date = start_date
+        self.start_date = pd.Timestamp(start_date)
         self.total_students = total_students
         self.r0 = r0
         self.quarantine_factor = quarantine_factor
@@ -73,47 +198,81 @@ class Model3:
         self.pct_death = pct_death
         self.quarantine_period = quarantine_period
         self.quarantine_success = quarantine_success
-        series = df_summary.loc[start_date, ['Active Student Cases', 'Total Student Cases', 'Active Staff Cases', 'Total Staff Cases', 'Quarantined Students', 'Quarantined Staff']]
-        self.df = pd.DataFrame(series.T).T
-        self.df.rename(columns = {'Active Student Cases': 'Active Cases', 'Total Student Cases': 'Total Cases', 'Quarantined Students': 'Quarantined'}, inplace = True)
-        self.df['New Cases'] = df_summary.loc[start_date]['New Student Cases']
-        self.df['New Quarantined'] = self.df['Quarantined']
-        self.df = self.df.reindex(columns=['New Cases', 'Active Cases', 'Total Cases', 'New Quarantined', 'Quarantined'])
+        self.rng = np.random.default_rng(seed)
 
-    def tick(self):
-        last_day = self.df.index[-1]
-        today = last_day + pd.Timedelta(1, 'day')
-
-        # figure the new cases from spread in school
-        # also figure the new cases among those quarantined
-        new_cases_in_school = self.r0 * self.df['New Cases'][-1] * (1 - self.quarantine_success)
-        new_cases_among_quarantined = self.r0 * self.df['New Cases'][-1] * self.quarantine_success
-        # remove (1 / quarantine_period) * quarantined from the quarantine amt every day
-        pct_quarantine_resolved_in_period = (1. / self.quarantine_period)
-        active_cases = (1 - pct_quarantine_resolved_in_period) * self.df['Active Cases'][-1] + new_cases
-        total_cases = self.df['Total Cases'][-1] + new_cases
-        new_quarantined = new_cases * self.quarantine_factor
-        quarantined = active_cases * self.quarantine_factor
-        resolved_cases = total_cases - active_cases
-        if today.day_of_week in [0, 6]:
-            # on sundays and mondays no case growth because kids aren't in school the day before
-            # this means the model's saturday case growth should match the reported data's monday case growth
-            r_rel = 0
-        else:
-            r_rel = pct_susceptible_students / self.df['% Susceptible Students Remaining'][0]
-        r = r_rel * self.df['R_tick'][0]
-        self.df.loc[today] = [
-            susceptible_students_remaining,
-            pct_susceptible_students,
-            r_rel,
-            r,
+        row = df_summary.loc[start_date]
+        new_cases = max(int(row['New Student Cases']), 0)
+        quarantined = int(np.nan_to_num(row['Quarantined Students']))
+        # every replicate is a row of a (day, column, replicate) array that grows like Model2's
+        self._values = np.empty((64, len(MODEL3_COLUMNS), replicates), dtype=np.int64)
+        self._values[0] = np.array([
             new_cases,
-            active_cases,
-            total_cases,
-            new_quarantined,
+            round(new_cases * (1 - quarantine_success)),
+            row['Active Student Cases'],
+            row['Total Student Cases'],
+            quarantined,
             quarantined
-        ]
+        ], dtype=np.int64)[:, np.newaxis]
+        self._n = 1
+
+    @property
+    def index(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(self.start_date + pd.to_timedelta(np.arange(self._n), 'D'))
+
+    @property
+    def values(self) -> np.ndarray:
+        # shaped (replicate, day, column)
+        return self._values[:self._n].transpose(2, 0, 1)
 
+    @property
+    def df(self) -> pd.DataFrame:
+        # the mean over the replicates
+        return pd.DataFrame(self._values[:self._n].mean(axis=2), index=self.index, columns=MODEL3_COLUMNS)
+
+    def bands(self, percentiles: Sequence[float] = (5, 50, 95)) -> pd.DataFrame:
+        bands = np.percentile(self._values[:self._n], percentiles, axis=2)
+        columns = pd.MultiIndex.from_product([MODEL3_COLUMNS, percentiles], names=['Column', 'Percentile'])
+        return pd.DataFrame(bands.transpose(1, 2, 0).reshape(self._n, -1), index=self.index, columns=columns)
+
+    def tick(self):
+        self.run(1)
+
+    @profiling.profiled('techniques.model3_run')
+    def run(self, days: int):
+        if self._n + days > len(self._values):
+            values = np.empty((max(2 * len(self._values), self._n + days), ) + self._values.shape[1:], dtype=np.int64)
+            values[:self._n] = self._values[:self._n]
+            self._values = values
+
+        values = self._values
+        total_cases_start = values[0, 3]
+        pct_resolved_per_day = 1. / self.quarantine_period
+        for i in range(self._n, self._n + days):
+            if (self.start_date.day_of_week + i) % 7 in [0, 6]:
+                # on sundays and mondays no case growth because kids aren't in school the day before
+                r = np.zeros(values.shape[2])
+            elif self.total_students:
+                # fewer susceptible students left means less spread
+                r = self.r0 * np.clip(self.total_students - values[i - 1, 3], 0, None) / (self.total_students - total_cases_start)
+            else:
+                r = np.full(values.shape[2], float(self.r0))
+            # only the cases that were in school spread it, cases among those already quarantined don't
+            new_cases = self.rng.poisson(r * values[max(0, i - 5):i, 1].mean(axis=0))
+            new_cases_among_quarantined = self.rng.binomial(new_cases, self.quarantine_success)
+            new_cases_in_school = new_cases - new_cases_among_quarantined
+            new_quarantined = self.rng.poisson(new_cases_in_school * self.quarantine_factor)
+            # remove (1 / quarantine_period) of the active cases and quarantined every day
+            active_cases = values[i - 1, 2] - self.rng.binomial(values[i - 1, 2], pct_resolved_per_day) + new_cases
+            quarantined = values[i - 1, 5] - self.rng.binomial(values[i - 1, 5], pct_resolved_per_day) + new_quarantined
+            values[i, 0] = new_cases
+            values[i, 1] = new_cases_in_school
+            values[i, 2] = active_cases
+            values[i, 3] = values[i - 1, 3] + new_cases
+            values[i, 4] = new_quarantined
+            values[i, 5] = quarantined
+        self._n += days
+
+MODEL3_COLUMNS = ['New Cases', 'New Cases In School', 'Active Cases', 'Total Cases', 'New Quarantined', 'Quarantined']
 
 class Model2:
     def __init__(self,
@@ -130,7 +289,8 @@ class Model2:
         if start_date not in df_summary.index:
             raise IndexError
 
-        self.start_date = start_date
+        # callers may pass the date as a string, which the index lookups accept but the date arithmetic doesn't
+        self.start_date = pd.Timestamp(start_date)
         self.total_students = total_students
         self.seroprevalence = seroprevalence
         self.r0 = r0
@@ -139,53 +299,92 @@ class Model2:
         self.pct_severe = pct_severe
         self.pct_death = pct_death
         self.quarantine_period = quarantine_period
-        series = df_summary.loc[start_date, ['Active Student Cases', 'Total Student Cases', 'Active Staff Cases', 'Total Staff Cases', 'Quarantined Students', 'Quarantined Staff']]
-        self.df = pd.DataFrame(series.T).T
-        self.df.rename(columns = {'Active Student Cases': 'Active Cases', 'Total Student Cases': 'Total Cases', 'Quarantined Students': 'Quarantined'}, inplace = True)
-        self.df['Susceptible Students Remaining'] = [
-            total_students * (1 - seroprevalence) - 
-              df_summary.loc[start_date]['Quarantined Students'] -
-              df_summary.loc[start_date]['Student Cases Resolved']
+        row = df_summary.loc[start_date]
+        susceptible_students_remaining = total_students * (1 - seroprevalence) - row['Quarantined Students'] - row['Student Cases Resolved']
+        pct_susceptible_students = susceptible_students_remaining / total_students
+        rel_pop_dens = pct_susceptible_students / pct_susceptible_students
+
+        # rows are appended into a preallocated array, the DataFrame is only built when self.df is read
+        self._values = np.empty((64, len(MODEL2_COLUMNS)))
+        self._values[0] = [
+            susceptible_students_remaining,
+            pct_susceptible_students,
+            rel_pop_dens,
+            r0 * rel_pop_dens,
+            row['New Student Cases'],
+            row['Active Student Cases'],
+            row['Total Student Cases'],
+            row['Quarantined Students'],
+            row['Quarantined Students']
         ]
-        self.df['% Susceptible Students Remaining'] = [self.df['Susceptible Students Remaining'][0] / total_students]
-        self.df['Rel pop dens'] = self.df['% Susceptible Students Remaining'][0] / self.df['% Susceptible Students Remaining'].shift(1, fill_value=self.df['% Susceptible Students Remaining'][0])
-        self.df['R_tick'] = [r0 * self.df['Rel pop dens'][-1]]
-        self.df['New Cases'] = df_summary.loc[start_date]['New Student Cases']
-        self.df['New Quarantined'] = self.df['Quarantined']
-        self.df = self.df.reindex(columns=['Susceptible Students Remaining', '% Susceptible Students Remaining', 'Rel pop dens', 'R_tick', 'New Cases', 'Active Cases', 'Total Cases', 'New Quarantined', 'Quarantined'])
+        self._n = 1
+        self._df = None
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._df is None:
+            index = pd.DatetimeIndex(self.start_date + pd.to_timedelta(np.arange(self._n), 'D'))
+            self._df = pd.DataFrame(self._values[:self._n].copy(), index=index, columns=MODEL2_COLUMNS)
+        return self._df
 
     def tick(self):
-        last_day = self.df.index[-1]
-        today = last_day + pd.Timedelta(1, 'day')
-
-        new_cases = self.df['R_tick'][-1] * self.df['New Cases'][-5:].mean()
-        # remove (1 / quarantine_period) * quarantined from the quarantine amt every day
-        pct_quarantine_resolved_in_period = (1. / self.quarantine_period)
-        active_cases = (1 - pct_quarantine_resolved_in_period) * self.df['Active Cases'][-1] + new_cases
-        total_cases = self.df['Total Cases'][-1] + new_cases
-        new_quarantined = new_cases * self.quarantine_factor
-        quarantined = active_cases * self.quarantine_factor
+        self.run(1)
+
+    @profiling.profiled('techniques.model2_run')
+    def run(self, days: int):
+        if self._n + days > len(self._values):
+            values = np.empty((max(2 * len(self._values), self._n + days), len(MODEL2_COLUMNS)))
+            values[:self._n] = self._values[:self._n]
+            self._values = values
+        _model2_run(self._values, self._n, days, self.start_date.day_of_week, self.total_students,
+                    self.seroprevalence, self.quarantine_factor, self.quarantine_period)
+        self._n += days
+        self._df = None
+
+MODEL2_COLUMNS = ['Susceptible Students Remaining', '% Susceptible Students Remaining', 'Rel pop dens', 'R_tick', 'New Cases', 'Active Cases', 'Total Cases', 'New Quarantined', 'Quarantined']
+
+def _model2_run(values: np.ndarray, n: int, days: int, start_day_of_week: int, total_students: int,
+                seroprevalence: float, quarantine_factor: float, quarantine_period: int):
+    # advances rows values[n:n + days] in place, values[:n] are the days already simulated
+    pct_susceptible_students_start = float(values[0, 1])
+    r_tick_start = float(values[0, 3])
+    new_cases_window = [float(x) for x in values[max(0, n - 5):n, 4]]
+    r_tick = float(values[n - 1, 3])
+    active_cases = float(values[n - 1, 5])
+    total_cases = float(values[n - 1, 6])
+
+    # remove (1 / quarantine_period) * quarantined from the quarantine amt every day
+    pct_quarantine_resolved_in_period = (1. / quarantine_period)
+    for i in range(n, n + days):
+        new_cases = r_tick * (sum(new_cases_window) / len(new_cases_window))
+        active_cases = (1 - pct_quarantine_resolved_in_period) * active_cases + new_cases
+        total_cases = total_cases + new_cases
+        new_quarantined = new_cases * quarantine_factor
+        quarantined = active_cases * quarantine_factor
         resolved_cases = total_cases - active_cases
-        susceptible_students_remaining = self.total_students * (1 - self.seroprevalence) - resolved_cases - quarantined
-        pct_susceptible_students = susceptible_students_remaining / self.total_students
-        if today.day_of_week in [0, 6]:
+        susceptible_students_remaining = total_students * (1 - seroprevalence) - resolved_cases - quarantined
+        pct_susceptible_students = susceptible_students_remaining / total_students
+        if (start_day_of_week + i) % 7 in [0, 6]:
             # on sundays and mondays no case growth because kids aren't in school the day before
             # this means the model's saturday case growth should match the reported data's monday case growth
             r_rel = 0
         else:
-            r_rel = pct_susceptible_students / self.df['% Susceptible Students Remaining'][0]
-        r = r_rel * self.df['R_tick'][0]
-        self.df.loc[today] = [
+            r_rel = pct_susceptible_students / pct_susceptible_students_start
+        r_tick = r_rel * r_tick_start
+        values[i] = (
             susceptible_students_remaining,
             pct_susceptible_students,
             r_rel,
-            r,
+            r_tick,
             new_cases,
             active_cases,
             total_cases,
             new_quarantined,
             quarantined
-        ]
+        )
+        new_cases_window.append(new_cases)
+        if len(new_cases_window) > 5:
+            del new_cases_window[0]
 
 def model1(df_summary: pd.DataFrame, total_students: int = 0, seroprevalence: int = 0, r0: int = 0, quarantine_factor: int = 0, pct_long_covid: float = 0, pct_severe: float = 0, pct_death: float = 0, quarantine_period: int = 0):
     pct_quarantine_resolved_in_period = 7 / quarantine_period # 7 days elapsed of 'quarantine_period' days
@@ -250,3 +449,180 @@ def model1(df_summary: pd.DataFrame, total_students: int = 0, seroprevalence: in
     
     return df_proj
 
+
+SWEEP_PARAMETERS = ['r0', 'seroprevalence', 'quarantine_factor', 'quarantine_period']
+MODEL1_COLUMNS = ['Week', 'Susceptible Students Remaining', '% Susceptible Students Remaining', 'Rel pop dens', 'R', 'New Cases', 'Active Cases', 'Total Cases', 'New Quarantined', 'Quarantined']
+
+class SweepResult:
+    def __init__(self, params: pd.DataFrame, values: np.ndarray, index: pd.DatetimeIndex, columns: List[str]):
+        # params has one row per ensemble member, values is shaped (member, day, column)
+        self.params = params
+        self.values = values
+        self.index = index
+        self.columns = columns
+
+    def best(self, n: int = 10) -> pd.DataFrame:
+        return self.params.nsmallest(n, 'Error')
+
+    def member(self, i: int) -> pd.DataFrame:
+        return pd.DataFrame(self.values[i], index=self.index, columns=self.columns)
+
+    def tidy(self) -> pd.DataFrame:
+        members, days, _ = self.values.shape
+        index = pd.MultiIndex.from_product([self.params.index, self.index], names=['Member', 'Datestamp'])
+        return pd.DataFrame(self.values.reshape(members * days, -1), index=index, columns=self.columns)
+
+@profiling.profiled('techniques.sweep')
+def sweep(df_summary: pd.DataFrame,
+          grid: Dict[str, Sequence[float]],
+          model: str = 'model2',
+          start_date: Optional[pd.Timestamp] = None,
+          days: int = 0,
+          total_students: int = 0,
+          columns: Optional[List[str]] = None,
+          fit: Tuple[str, str] = ('Active Cases', 'Active Student Cases'),
+          jobs: int = 1) -> SweepResult:
+    missing = [p for p in SWEEP_PARAMETERS if p not in grid]
+    unknown = [p for p in grid if p not in SWEEP_PARAMETERS]
+    if missing or unknown:
+        raise ValueError('grid needs exactly {}, missing {} unknown {}'.format(SWEEP_PARAMETERS, missing, unknown))
+
+    # the full cartesian product of the grid, one ensemble member per row
+    mesh = np.meshgrid(*[np.asarray(grid[p], dtype=np.float64) for p in SWEEP_PARAMETERS], indexing='ij')
+    params = pd.DataFrame({p: m.ravel() for p, m in zip(SWEEP_PARAMETERS, mesh)})
+
+    if model == 'model2':
+        if start_date not in df_summary.index:
+            raise IndexError
+        start_date = pd.Timestamp(start_date)
+        all_columns = MODEL2_COLUMNS
+        row = df_summary.loc[start_date]
+        start = row[['Quarantined Students', 'Student Cases Resolved', 'New Student Cases', 'Active Student Cases', 'Total Student Cases']].to_numpy(dtype=np.float64)
+        index = pd.DatetimeIndex(start_date + pd.to_timedelta(np.arange(days + 1), 'D'))
+        static = (start, days, start_date.day_of_week, total_students)
+    elif model == 'model1':
+        all_columns = MODEL1_COLUMNS
+        first = df_summary.iloc[0]
+        second = df_summary.loc['2021-09-21']
+        start = np.array([
+            first['Quarantined Students'], first['Student Cases Resolved'], df_summary['Change in Active Student Cases'][0],
+            first['Active Student Cases'], first['Total Student Cases'],
+            second['Quarantined Students'], second['Student Cases Resolved'],
+            df_summary['Active Student Cases'][1] - (df_summary['Active Student Cases'][0] - df_summary['Student Cases Newly Resolved'][1]),
+            df_summary['Active Student Cases'][1], df_summary['Total Student Cases'][1], df_summary['Change in Students Quarantined'][1],
+            df_summary['Quarantined Students'][1]
+        ], dtype=np.float64)
+        index = pd.DatetimeIndex([df_summary.index[0], pd.Timestamp(2021, 9, 21)] + [pd.Timestamp(2021, 9, 28) + pd.Timedelta(7 * x, 'D') for x in range(0, 13)])
+        static = (start, total_students)
+    else:
+        raise ValueError('unknown model {}'.format(model))
+
+    columns = all_columns if columns is None else columns
+    fitted, observed = fit
+    positions = ([all_columns.index(c) for c in columns], all_columns.index(fitted))
+    work = [(model, static, positions, chunk) for chunk in np.array_split(params.to_numpy(), max(1, jobs)) if len(chunk)]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_sweep_chunk, work))
+    else:
+        results = [_sweep_chunk(w) for w in work]
+    values = np.concatenate([r[0] for r in results])
+    projected = np.concatenate([r[1] for r in results])
+
+    # root mean squared error against the observed days inside the projection
+    observed = df_summary[observed].reindex(index).to_numpy(dtype=np.float64)
+    mask = ~np.isnan(observed)
+    params['Error'] = np.sqrt(np.mean((projected[:, mask] - observed[mask]) ** 2, axis=1)) if mask.any() else np.nan
+
+    return SweepResult(params, values, index, columns)
+
+def _sweep_chunk(args) -> Tuple[np.ndarray, np.ndarray]:
+    model, static, (column_positions, fit_position), chunk = args
+    r0, seroprevalence, quarantine_factor, quarantine_period = chunk.T
+    ensemble = _model2_ensemble if model == 'model2' else _model1_ensemble
+    values = ensemble(*static, r0, seroprevalence, quarantine_factor, quarantine_period)
+    return values[:, :, column_positions], values[:, :, fit_position]
+
+def _model2_ensemble(start: np.ndarray, days: int, start_day_of_week: int, total_students: int,
+                     r0: np.ndarray, seroprevalence: np.ndarray, quarantine_factor: np.ndarray, quarantine_period: np.ndarray) -> np.ndarray:
+    # Model2 for every ensemble member at once, each step is a handful of vector operations over the members
+    quarantined_students, student_cases_resolved, new_student_cases, active_student_cases, total_student_cases = start
+    # members are the innermost axis while stepping so each column write is contiguous
+    values = np.empty((days + 1, len(MODEL2_COLUMNS), len(r0)))
+    susceptible_students_remaining = total_students * (1 - seroprevalence) - quarantined_students - student_cases_resolved
+    pct_susceptible_students_start = susceptible_students_remaining / total_students
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_pop_dens = pct_susceptible_students_start / pct_susceptible_students_start
+    r_tick_start = r0 * rel_pop_dens
+    values[0, 0] = susceptible_students_remaining
+    values[0, 1] = pct_susceptible_students_start
+    values[0, 2] = rel_pop_dens
+    values[0, 3] = r_tick_start
+    values[0, 4] = new_student_cases
+    values[0, 5] = active_student_cases
+    values[0, 6] = total_student_cases
+    values[0, 7] = quarantined_students
+    values[0, 8] = quarantined_students
+
+    pct_quarantine_resolved_in_period = 1. / quarantine_period
+    for i in range(1, days + 1):
+        new_cases = values[i - 1, 3] * values[max(0, i - 5):i, 4].mean(axis=0)
+        active_cases = (1 - pct_quarantine_resolved_in_period) * values[i - 1, 5] + new_cases
+        total_cases = values[i - 1, 6] + new_cases
+        quarantined = active_cases * quarantine_factor
+        susceptible_students_remaining = total_students * (1 - seroprevalence) - (total_cases - active_cases) - quarantined
+        pct_susceptible_students = susceptible_students_remaining / total_students
+        if (start_day_of_week + i) % 7 in [0, 6]:
+            r_rel = np.zeros_like(pct_susceptible_students)
+        else:
+            r_rel = pct_susceptible_students / pct_susceptible_students_start
+        values[i, 0] = susceptible_students_remaining
+        values[i, 1] = pct_susceptible_students
+        values[i, 2] = r_rel
+        values[i, 3] = r_rel * r_tick_start
+        values[i, 4] = new_cases
+        values[i, 5] = active_cases
+        values[i, 6] = total_cases
+        values[i, 7] = new_cases * quarantine_factor
+        values[i, 8] = quarantined
+    return values.transpose(2, 0, 1)
+
+def _model1_ensemble(start: np.ndarray, total_students: int,
+                     r0: np.ndarray, seroprevalence: np.ndarray, quarantine_factor: np.ndarray, quarantine_period: np.ndarray) -> np.ndarray:
+    # model1 for every ensemble member at once: the two observed weeks followed by 13 projected weeks
+    (quarantined_students, student_cases_resolved, change_in_active, active_student_cases, total_student_cases,
+     week2_quarantined_students, week2_student_cases_resolved, week2_new_cases, week2_active_cases, week2_total_cases,
+     week2_new_quarantined, week2_quarantined) = start
+    pct_quarantine_resolved_in_period = 7 / quarantine_period # 7 days elapsed of 'quarantine_period' days
+    values = np.empty((len(r0), 15, len(MODEL1_COLUMNS)))
+
+    susceptible_students_remaining = total_students * (1 - seroprevalence) - quarantined_students - student_cases_resolved
+    pct_susceptible_students_start = susceptible_students_remaining / total_students
+    values[:, 0] = np.stack([
+        np.ones_like(r0), susceptible_students_remaining, pct_susceptible_students_start, np.ones_like(r0), r0,
+        np.full_like(r0, change_in_active), np.full_like(r0, active_student_cases), np.full_like(r0, total_student_cases),
+        np.full_like(r0, quarantined_students), np.full_like(r0, quarantined_students)
+    ], axis=1)
+
+    susceptible_students_remaining = total_students * (1 - seroprevalence) - week2_quarantined_students - week2_student_cases_resolved
+    pct_susceptible_students = susceptible_students_remaining / total_students
+    r_rel = pct_susceptible_students / pct_susceptible_students_start
+    values[:, 1] = np.stack([
+        np.full_like(r0, 2), susceptible_students_remaining, pct_susceptible_students, r_rel, r_rel * r0,
+        np.full_like(r0, week2_new_cases), np.full_like(r0, week2_active_cases), np.full_like(r0, week2_total_cases),
+        np.full_like(r0, week2_new_quarantined), np.full_like(r0, week2_quarantined)
+    ], axis=1)
+
+    for i in range(2, 15):
+        new_cases = values[:, i - 1, 4] * values[:, i - 1, 5]
+        active_cases = (1 - pct_quarantine_resolved_in_period) * values[:, i - 1, 5] + new_cases
+        total_cases = values[:, i - 1, 7] + new_cases
+        quarantined = active_cases * quarantine_factor
+        susceptible_students_remaining = total_students * (1 - seroprevalence) - (total_cases - active_cases) - quarantined
+        pct_susceptible_students = susceptible_students_remaining / total_students
+        r_rel = pct_susceptible_students / pct_susceptible_students_start
+        values[:, i] = np.stack([
+            values[:, i - 1, 0] + 1, susceptible_students_remaining, pct_susceptible_students, r_rel, r_rel * r0,
+            new_cases, active_cases, total_cases, new_cases * quarantine_factor, quarantined
+        ], axis=1)
+    return values